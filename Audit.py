@@ -3,9 +3,11 @@
 
 # In[28]:
 import xml.etree.cElementTree as ET
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import re
 import pprint
+from timeit import default_timer as clock
+from osm_io import open_osm, expat_elements, BACKENDS, DEFAULT_BACKEND
 
 OSMFILE = (r"C:\Users\Marcus\Documents\School Documents\Python Environments\Unit_4\sample1percent.osm")
 street_type_re = re.compile(r'\b\S+\.?$', re.IGNORECASE)
@@ -30,38 +32,11 @@ def is_street_name(elem):
     return (elem.attrib['k'] == "addr:street")
 
 
-""" Here we create a dictionary of type set called street_types, 
-and turn the open function into a variable for ease of use in the future 
-Next is my pride and joy, instead of using "for et.iterparse" to iterate directly line by line
-through the file instead we use the osm_file var to open the file in memory, and 
-then turn it into an iterable. This saves a TON of time, as we can iterate on the file
-in memory instead of iterating the file line by line. Once we do this, we then iterate through and
-for each tag that matches "node" or "way", we check if it is a street name, and if so we run the audit_street_types function.
-we then clear the root tree, saving memory and time, close the file, and return the updated street_types dict.
-"""
+# Runs only the street auditor. Use audit_file to run several auditors in one pass.
+# backend picks the XML parser, 'etree' or the faster 'expat', see osm_io.py.
+def audit_s(osmfile, backend=None):
+    return audit_file(osmfile, ['street'], backend)['street']
 
-def audit_s(osmfile):
-    street_types = defaultdict(set)
-    osm_file = open(osmfile, "r")
-
-    # get an iterable
-    iterable = ET.iterparse(osm_file, events=("start", "end"))
-
-    # turn it into an iterator
-    iterable = iter(iterable)
-
-    # get the root element
-    event, root = iterable.next()
-
-    for event, elem in iterable:
-        if event == "end" and (elem.tag == "node" or elem.tag == "way"):
-            for tag in elem.iter("tag"):
-                if is_street_name(tag):
-                    audit_street_type(street_types, tag.attrib['v'])
-        root.clear()
-    
-    osm_file.close()
-    return street_types
 """ The update_street function takes the information we learned from the audit_s function
 and utilizes that to check a manually created mapping dictionary and DONT_UPDATE tuple.
 These two objects are created by reading the report from audit_s and choosing how we want to standardize the types.
@@ -72,8 +47,8 @@ the value is not updated. To fix the street types, we broke the value into parts
 seperated by whitespace using .split(), then change the value if it matches the key found in mapping, to the paired value.
 Finally, the seperated parts are then rejoined with a space inbetween using the .join() function.
 """
-def update_street(name):
-    mapping = {"St": "Street",
+# The mapping tables are built once when the module is loaded instead of on every call.
+mapping = {"St": "Street",
            "Rd.": "Road",
            "Rd": "Road",
            "N.": "North",
@@ -95,8 +70,9 @@ def update_street(name):
            "MO-94": "Highway 94"
           }
 
-    DONT_UPDATE = ('route','suite')
+DONT_UPDATE = ('route','suite')
 
+def update_street(name):
     if name.lower().startswith(DONT_UPDATE):
         return name
     else: 
@@ -114,27 +90,8 @@ def is_postcode(elem):
     return (elem.attrib['k'] == "addr:postcode")
 
 #This codes is identical in function the the street function of similar name
-def audit_p(osmfile):
-    osm_file = open(OSMFILE, "r")
-    data = defaultdict(int)
-
-    # get an iterable
-    iterable = ET.iterparse(osm_file, events=("start", "end"))
-
-    # turn it into an iterator
-    iterable = iter(iterable)
-
-    # get the root element
-    event, root = iterable.next()
-
-    for event, elem in iterable:
-        if event == "end" and (elem.tag == "node" or elem.tag == "way"):
-            for tag in elem.iter("tag"):
-                if is_postcode(tag):
-                    dicti(data, tag.attrib['v'])
-        root.clear()
-    osm_file.close()
-    return data
+def audit_p(osmfile, backend=None):
+    return audit_file(osmfile, ['postcode'], backend)['postcode']
 
 # This is the function that actually changes the post code to the proper values
 # It is called in the OSM_to_XML file, when writing the changes to the .csv
@@ -142,8 +99,9 @@ def audit_p(osmfile):
 def update_postcode(postcodes):
     output = list()
     
-    if re.search(postcodes_re, postcodes):
-        new_zip = re.search(postcodes_re, postcodes).group(1)
+    m = postcodes_re.search(postcodes)
+    if m:
+        new_zip = m.group(1)
         output.append(new_zip)
 
     return ', '.join(str(x) for x in output)
@@ -161,36 +119,16 @@ def is_city(elem):
     return (elem.attrib['k'] == "addr:city")
 
 #Same function as audit_s, but for city values.
-def audit_C(osmfile):
-    city_dict = defaultdict(set)
-    osm_file = open(osmfile, "r")
-
-    # get an iterable
-    iterable = ET.iterparse(osm_file, events=("start", "end"))
-
-    # turn it into an iterator
-    iterable = iter(iterable)
-
-    # get the root element
-    event, root = iterable.next()
-
-    for event, elem in iterable:
-        if event == "end" and (elem.tag == "node" or elem.tag == "way"):
-            for tag in elem.iter("tag"):
-                if is_city(tag):
-                    audit_city(city_dict, tag.attrib['v'])
-        root.clear()
-    osm_file.close()
-    return city_dict
+def audit_C(osmfile, backend=None):
+    return audit_file(osmfile, ['city'], backend)['city']
 
 """ Same function as the update_street, except instead of it skipping the
 the matched tuple, instead it instead uses the ofallon_mapping dict to correct the
 inconsistency of some cities being listed as O'fallon and some as O fallon. 
 """
-def update_city(name):
-    OFALLON = ('o')
-    ofallon_mapping = {"O": "O'"}
-    city_mapping = {"St": "Saint",
+OFALLON = ('o')
+ofallon_mapping = {"O": "O'"}
+city_mapping = {"St": "Saint",
                 "St.": "Saint",
                 "bridgeton" : "Bridgeton",
                 "drive-through": "O'Fallon",
@@ -200,22 +138,167 @@ def update_city(name):
                 "UNINCORPORATED": "Saint Peters",
                 }
 
+def update_city(name):
     if name.lower().startswith(OFALLON):
         return ''.join((ofallon_mapping.get(part, part)).title() for part in name.split())
     return ' '.join((city_mapping.get(part, part)).title() for part in name.split())
 
 
+""" The full dataset only has a few thousand different street, city and postcode values, but
+each of them shows up over and over. NormalizationCache sits in front of an update function and
+remembers what it returned for each value, so cleaning a repeated value is a dictionary lookup.
+The cache holds at most maxsize values, and when it is full the least recently used value is
+dropped. The hits, misses and evictions counters show how well the cache is working, and
+seconds is the time spent in the update function, which instrumentation.py reports as cleaning.
+shape_element in OSM_to_CSV.py calls street_cache, postcode_cache and city_cache.
+"""
+CACHE_SIZE = 10000
+
+class NormalizationCache(object):
+
+    def __init__(self, func, maxsize=CACHE_SIZE):
+        self.func = func
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.seconds = 0.0
+
+    def __call__(self, value):
+        cache = self.cache
+        try:
+            # Popping and re-adding the value moves it to the most recently used end.
+            result = cache.pop(value)
+            self.hits += 1
+        except KeyError:
+            start = clock()
+            result = self.func(value)
+            self.seconds += clock() - start
+            self.misses += 1
+            if len(cache) >= self.maxsize:
+                cache.popitem(last=False)
+                self.evictions += 1
+        cache[value] = result
+        return result
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'size': len(self.cache),
+                'seconds': self.seconds}
+
+    def clear(self):
+        self.cache.clear()
+        self.hits = self.misses = self.evictions = 0
+        self.seconds = 0.0
+
+street_cache = NormalizationCache(update_street)
+postcode_cache = NormalizationCache(update_postcode)
+city_cache = NormalizationCache(update_city)
+
+#Returns the counters of each normalization cache, keyed by the kind of value it cleans.
+def cache_stats():
+    return {'street': street_cache.stats(),
+            'postcode': postcode_cache.stats(),
+            'city': city_cache.stats()}
+
+
+# Auditors are registered by the tag key they care about. Each entry holds the
+# function that records a matching value and a factory for its empty result,
+# so audit_file can run any number of them over a single parse of the file.
+auditors = {}
+
+def register_auditor(name, key, audit_func, factory):
+    """Register an auditor to be run by audit_file.
+    Every tag whose 'k' attribute equals key has its 'v' value passed to
+    audit_func(result, value), where result was created by calling factory()."""
+    auditors[name] = (key, audit_func, factory)
+
+register_auditor('street', 'addr:street', audit_street_type, lambda: defaultdict(set))
+register_auditor('postcode', 'addr:postcode', dicti, lambda: defaultdict(int))
+register_auditor('city', 'addr:city', audit_city, lambda: defaultdict(set))
+
+
+""" Here we create one result per auditor, and group the auditors by the tag key they
+want so each tag only costs a single dictionary lookup.
+Next is my pride and joy, instead of using "for et.iterparse" to iterate directly line by line
+through the file instead we use the osm_file var to open the file in memory, and 
+then turn it into an iterable. This saves a TON of time, as we can iterate on the file
+in memory instead of iterating the file line by line. Once we do this, we then iterate through and
+for each tag that matches "node" or "way", we hand its value to every auditor registered for its key.
+we then clear the root tree, saving memory and time, close the file, and return the results of
+every auditor in a dict keyed by auditor name. The file is only parsed once no matter how many
+auditors are run. With backend='expat' the file is parsed by osm_io.expat_elements instead, which
+only keeps the tags with a key some auditor wants, so elements without any are never built.
+"""
+def audit_file(osmfile, names=None, backend=None):
+    if names is None:
+        names = list(auditors)
+    backend = backend or DEFAULT_BACKEND
+    if backend not in BACKENDS:
+        raise ValueError('Unknown parser backend: %r' % backend)
+
+    results = {}
+    by_key = defaultdict(list)
+    for name in names:
+        key, audit_func, factory = auditors[name]
+        results[name] = factory()
+        by_key[key].append((audit_func, results[name]))
+
+    # open_osm decompresses .gz and .bz2 files as they are read, and opens .pbf files
+    # with pbf_reader.py, see osm_io.py.
+    osm_file = open_osm(osmfile)
+
+    # A PBF file hands out its nodes and ways as records, and the expat backend builds
+    # records with only the tags the auditors want, so there is no tree to clear.
+    if hasattr(osm_file, 'elements'):
+        records = osm_file.elements(('node', 'way'))
+    elif backend == 'expat':
+        records = expat_elements(osm_file, ('node', 'way'), keys=by_key)
+    else:
+        records = None
+
+    if records is not None:
+        for elem in records:
+            for k, v in elem.tags:
+                for audit_func, result in by_key.get(k, ()):
+                    audit_func(result, v)
+        osm_file.close()
+        return results
+
+    # get an iterable
+    iterable = ET.iterparse(osm_file, events=("start", "end"))
+
+    # turn it into an iterator
+    iterable = iter(iterable)
+
+    # get the root element
+    event, root = next(iterable)
+
+    for event, elem in iterable:
+        if event == "end" and (elem.tag == "node" or elem.tag == "way"):
+            for tag in elem.iter("tag"):
+                for audit_func, result in by_key.get(tag.attrib['k'], ()):
+                    audit_func(result, tag.attrib['v'])
+            root.clear()
+        elif event == "end" and elem.tag == "relation":
+            root.clear()
+
+    osm_file.close()
+    return results
+
 
 def test():
 
-    street_types = audit_s(OSMFILE)
-    pprint.pprint(dict(street_types))
+    results = audit_file(OSMFILE)
 
+    street_types = results['street']
+    pprint.pprint(dict(street_types))
 
-    postcodes = audit_p(OSMFILE)
+    postcodes = results['postcode']
     pprint.pprint(dict(postcodes))
 
-    c_names = audit_C(OSMFILE)
+    c_names = results['city']
     pprint.pprint(dict(c_names))
 
     for st_type, ways in street_types.items():
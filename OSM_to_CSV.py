@@ -156,12 +156,21 @@ The final return value for a "way" element should look something like:
 
 import csv
 import codecs
+import multiprocessing
+import os
 import pprint
 import re
+import shutil
+import tempfile
+from contextlib import closing
 import xml.etree.cElementTree as ET
 from Audit import *
-import cerberus
 import schema
+import schema_compiler
+from osm_io import open_osm, file_format, expat_elements, OSMElement, RangeReader, BACKENDS, DEFAULT_BACKEND
+from instrumentation import Metrics, ProgressSink, ROW_FILES
+from background_writer import BackgroundWriter
+from checkpoint import Checkpoint, SEGMENT_SIZE
 
 SCHEMA = schema.schema
 
@@ -172,6 +181,7 @@ NODE_TAGS_PATH = "nodes_tags.csv"
 WAYS_PATH = "ways.csv"
 WAY_NODES_PATH = "ways_nodes.csv"
 WAY_TAGS_PATH = "ways_tags.csv"
+CSV_PATHS = (NODES_PATH, NODE_TAGS_PATH, WAYS_PATH, WAY_NODES_PATH, WAY_TAGS_PATH)
 
 LOWER_COLON = re.compile(r'^([a-z]|_)+:([a-z]|_)+')
 PROBLEMCHARS = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
@@ -182,6 +192,13 @@ NODE_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
 WAY_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_NODES_FIELDS = ['id', 'node_id', 'position']
+CSV_FIELDS = (NODE_FIELDS, NODE_TAGS_FIELDS, WAY_FIELDS, WAY_NODES_FIELDS, WAY_TAGS_FIELDS)
+
+# The schema entries of the rows of each csv, in the same order.
+SCHEMA_KEYS = ('node', 'node_tags', 'way', 'way_nodes', 'way_tags')
+
+# How many elements are shaped before their rows are validated and written.
+ROW_BATCH_SIZE = 10000
 
 mapping = {"St": "Street",
            "Rd.": "Road",
@@ -207,6 +224,60 @@ mapping = {"St": "Street",
 
 
 
+def shape_tag_pair(element_id, tk, tv, problem_chars=PROBLEMCHARS, default_tag_type='regular'):
+    """Clean and shape a secondary tag, already split into its key and value, to a tuple in
+    NODE_TAGS_FIELDS / WAY_TAGS_FIELDS order. Returns None if the tag key has problem characters."""
+    if problem_chars.search(tk):
+        return None
+
+    # Calling the street_update function, through its cache, to clean up problematic
+    # street names based on Audit.py file.
+    if tk == "addr:street":
+        value = street_cache(tv)
+
+    # Calling the update_postcode function to clean up problematic
+    # postcodes based on Audit.py file.
+    elif tk == "addr:postcode":
+        value = postcode_cache(tv)
+
+    # Calling the update_city function to clean up problematic
+    # city names based on Audit.py file.
+    elif tk == "addr:city":
+        value = city_cache(tv)
+
+    # For other values that are not street names, postcodes or cities.
+    else:
+        value = tv
+
+    if ':' not in tk:
+        return (element_id, tk, value, default_tag_type)
+
+    # Dividing words before and after a colon ':'
+    tk_split = tk.split(":")
+    if len(tk_split) == 2: #If the key was an empty field
+        key = tk_split[1]
+    elif len(tk_split) == 3:
+        key = tk_split[1] + ":" + tk_split[2]
+    else:
+        key = tk
+    return (element_id, key, value, tk_split[0])
+
+
+def tag_pairs(element):
+    """The (k, v) pairs of the element's <tag> children. OSMElement records from
+    osm_io.py already hold them, so they don't have to be made into children first."""
+    if isinstance(element, OSMElement):
+        return element.tags
+    return [(tagz.attrib['k'], tagz.attrib['v']) for tagz in element.iter('tag')]
+
+
+def node_refs(element):
+    """The refs of the element's <nd> children, see tag_pairs"""
+    if isinstance(element, OSMElement):
+        return element.refs
+    return [tagz.attrib['ref'] for tagz in element.iter('nd')]
+
+
 def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIELDS,
                   problem_chars=PROBLEMCHARS, default_tag_type='regular'):
     """Clean and shape node or way XML element to Python dict"""
@@ -222,54 +293,10 @@ def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIE
             except:
                 node_attribs[item] = "9999999"
     #Iterating Through 'tag' elements
-        for tagz in element.iter('tag'):
-            tk = tagz.attrib['k']
-            tv = tagz.attrib['v']
-            if not problem_chars.search(tk):
-                tag_dict_node = {}
-                tag_dict_node['id'] = element.attrib['id']
-
-                # Calling the street_update function to clean up problematic
-                # street names based on Audit.py file.
-                if is_street_name(tagz):
-                    better_name_node = update_street(tv)
-                    tag_dict_node['value'] = better_name_node
-
-                # Calling the update_postcode function to clean up problematic
-                # postcodes based on Audit.py file.
-                elif is_postcode(tagz):
-                    better_postcode_node = update_postcode(tv)
-                    tag_dict_node['value'] = better_postcode_node
-
-                # Calling the update_postcode function to clean up problematic
-                # postcodes based on Audit.py file.
-                elif is_city(tagz):
-                    better_city_node = update_city(tv)
-                    tag_dict_node['value'] = better_city_node
-                
-                else:
-                    tag_dict_node['value'] = tv
-
-                if ':' not in tk:
-                    tag_dict_node['key'] = tk
-                    tag_dict_node['type'] = 'regular'
-                # Dividing words before and after a colon ':'
-                else:
-                    tk_split = tk.split(":")
-                    if len(tk_split) == 2: #If the key was an empty field
-                        tag_dict_node['key'] = tk_split[1]
-
-                    elif len(tk_split) == 3:
-                        tag_dict_node['key'] = tk_split[1] + ":" + tk_split[2]
-                    else:
-                        tag_dict_node['key'] = tk
-
-                    if len(tk_split) >= 2: #If the key was an empty field
-                        tag_dict_node['type'] = tk_split[0]
-                    else:
-                        tag_dict_node['type'] = 'regular'
-                tags.append(tag_dict_node)
-        print({'node': node_attribs})
+        for tk, tv in tag_pairs(element):
+            tag_row = shape_tag_pair(element.attrib['id'], tk, tv, problem_chars, default_tag_type)
+            if tag_row is not None:
+                tags.append(dict(zip(NODE_TAGS_FIELDS, tag_row)))
         return {'node': node_attribs, 'node_tags': tags}
 
     elif element.tag == 'way':
@@ -280,62 +307,16 @@ def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIE
                 way_attribs[item] = "9999999"
 
         # Iterating through 'tag' tags in way element.
-        for tagz in element.iter('tag'):
-            wk = tagz.attrib['k']
-            wv = tagz.attrib['v']
-            if not problem_chars.search(wk):
-                tag_dict_way = {}
-                tag_dict_way['id'] = element.attrib['id']
-
-                # Calling the street_update function to clean up problematic
-                # street names based on audit.py file.
-                if is_street_name(tagz):
-                    better_name_way = update_street(wv)
-                    tag_dict_way['value'] = better_name_way
-
-                # Calling the update_postcode function to clean up problematic
-                # postcodes based on audit.py file.
-                elif is_postcode(tagz):
-                    better_postcode_way = update_postcode(wv)
-                    tag_dict_way['value'] = better_postcode_way
-
-                # Calling the update_postcode function to clean up problematic
-                # postcodes based on audit.py file.
-                elif is_city(tagz):
-                    better_city_way = update_city(wv)
-                    tag_dict_way['value'] = better_city_way
-
-                # For other values that are not street names or postcodes.
-                else:
-                    tag_dict_way['value'] = wv
-
-                if ':' not in wk:
-                    tag_dict_way['key'] = wk
-                    tag_dict_way['type'] = 'regular'
-                #Dividing words before and after a colon ':'
-                else:
-                    wk_split = wk.split(":")
-
-                    if len(wk_split) == 2: #If the key was an empty field
-                        tag_dict_way['key'] = wk_split[1]
-
-                    elif len(wk_split) == 3:
-                        tag_dict_way['key'] = wk_split[1] + ":" + wk_split[2]
-                    else:
-                        tag_dict_way['key'] = tk
-
-                    if len(wk_split) >= 2: #If the key was an empty field
-                        tag_dict_way['type'] = wk_split[0]
-                    else:
-                        tag_dict_way['type'] = 'regular'
-
-                tags.append(tag_dict_way)
+        for tk, tv in tag_pairs(element):
+            tag_row = shape_tag_pair(element.attrib['id'], tk, tv, problem_chars, default_tag_type)
+            if tag_row is not None:
+                tags.append(dict(zip(WAY_TAGS_FIELDS, tag_row)))
 
     # Iterating through 'nd' tags in way element.
-        for index, tagz in enumerate(element.iter('nd')):
+        for index, ref in enumerate(node_refs(element)):
             tag_dict_nd = {}
             tag_dict_nd['id'] = element.attrib['id']
-            tag_dict_nd['node_id'] = tagz.attrib['ref']
+            tag_dict_nd['node_id'] = ref
             tag_dict_nd['position'] = index
 
             way_nodes.append(tag_dict_nd)
@@ -343,13 +324,73 @@ def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIE
         return {'way': way_attribs, 'way_nodes': way_nodes, 'way_tags': tags}
 
 
+def shape_element_rows(element, problem_chars=PROBLEMCHARS, default_tag_type='regular'):
+    """Clean and shape node or way XML element to tuples in the csv field orders.
+
+    This is the compact version of shape_element, it makes one tuple per row instead of a dict.
+    Returns (element_row, tag_rows, way_node_rows), where element_row is in NODE_FIELDS or
+    WAY_FIELDS order and way_node_rows is None for nodes."""
+    attrib = element.attrib
+    if element.tag == 'node':
+        element_row = tuple([attrib.get(item, "9999999") for item in NODE_FIELDS])
+    else:
+        element_row = tuple([attrib.get(item, "9999999") for item in WAY_FIELDS])
+    element_id = element_row[0]
+
+    tag_rows = []
+    for tk, tv in tag_pairs(element):
+        tag_row = shape_tag_pair(element_id, tk, tv, problem_chars, default_tag_type)
+        if tag_row is not None:
+            tag_rows.append(tag_row)
+
+    if element.tag == 'node':
+        return element_row, tag_rows, None
+
+    way_node_rows = [(element_id, ref, index)
+                     for index, ref in enumerate(node_refs(element))]
+    return element_row, tag_rows, way_node_rows
+
+
 # ================================================== #
 #               Helper Functions                     #
 # ================================================== #
-def get_element(osm_file, tags=('node', 'way', 'relation')):
-    """Yield element if it is the right type of tag"""
+def get_element(osm_file, tags=('node', 'way', 'relation'), node_locations=None, backend=None):
+    """Yield element if it is the right type of tag
+
+    osm_file is a path or a file opened with osm_io.open_osm. Paths to .gz and .bz2
+    files are decompressed as they are read, and .pbf files are read with pbf_reader.py.
+    If node_locations is a NodeLocationIndex (see node_locations.py), the location of
+    every node is added to it as the file is streamed, so the ways after the nodes can
+    be resolved to coordinates with node_locations.way_coordinates.
+    backend picks the XML parser, 'etree' (ElementTree's iterparse) or 'expat', which
+    is faster and yields osm_io.OSMElement records instead, see osm_io.py."""
+
+    backend = backend or DEFAULT_BACKEND
+    if backend not in BACKENDS:
+        raise ValueError('Unknown parser backend: %r' % backend)
+    opened = not hasattr(osm_file, 'read') and not hasattr(osm_file, 'elements')
+    source = open_osm(osm_file) if opened else osm_file
+    try:
+        # A PBFReader hands out element records itself, anything else is XML.
+        if hasattr(source, 'elements'):
+            elements = source.elements(tags)
+        elif backend == 'expat':
+            elements = expat_elements(source, tags)
+        else:
+            elements = iterparse_elements(source, tags)
+        for elem in elements:
+            if node_locations is not None and elem.tag == 'node':
+                node_locations.add_element(elem)
+            yield elem
+    finally:
+        if opened:
+            source.close()
+
 
-    context = ET.iterparse(osm_file, events=('start', 'end'))
+def iterparse_elements(source, tags):
+    """Yield the top level XML elements of the given tags, clearing each one after use"""
+
+    context = ET.iterparse(source, events=('start', 'end'))
     _, root = next(context)
     for event, elem in context:
         if event == 'end' and elem.tag in tags:
@@ -366,6 +407,47 @@ def validate_element(element, validator, schema=SCHEMA):
         raise Exception(message_string.format(field, error_string))
 
 
+def compile_row_validators(schema=SCHEMA):
+    """Compile a schema_compiler.RowValidator for the rows of each csv, by its table name"""
+    validators = {}
+    for table, key, fields in zip(ROW_FILES, SCHEMA_KEYS, CSV_FIELDS):
+        rule = schema[key]
+        if rule.get('type') == 'list':
+            rule = rule['schema']
+        validators[table] = schema_compiler.compile_rows(rule['schema'], fields)
+    return validators
+
+
+def validate_rows(table, rows, validators):
+    """Raise ValidationError if any row in a batch of rows for table does not match schema.
+    The rows can be tuples from shape_element_rows or dicts from shape_element."""
+    failures = validators[table].validate_many(rows)
+    if failures:
+        position, errors = failures[0]
+        message_string = "\nRow {0} of the batch of {1} rows has the following errors:\n{2}\n{3}"
+        error_string = pprint.pformat(errors)
+        raise Exception(message_string.format(position, table, error_string, pprint.pformat(rows[position])))
+
+
+def validate_element_rows(tag, rows, validators):
+    """Raise ValidationError if any of the rows of one element from shape_element_rows
+    does not match schema"""
+    element_row, tag_rows, way_node_rows = rows
+    if tag == 'node':
+        validate_rows('nodes', [element_row], validators)
+        validate_rows('nodes_tags', tag_rows, validators)
+    else:
+        validate_rows('ways', [element_row], validators)
+        validate_rows('ways_nodes', way_node_rows, validators)
+        validate_rows('ways_tags', tag_rows, validators)
+
+
+def validate_batches(batches, validators):
+    """Validate a batch of rows for each csv, in the order of CSV_FIELDS"""
+    for table, batch in zip(ROW_FILES, batches):
+        validate_rows(table, batch, validators)
+
+
 class UnicodeDictWriter(csv.DictWriter, object):
     """Extend csv.DictWriter to handle Unicode input"""
 
@@ -378,51 +460,387 @@ class UnicodeDictWriter(csv.DictWriter, object):
         for row in rows:
             self.writerow(row)
 
+
+class UnicodeRowWriter(object):
+    """Write tuple rows with csv.writer, only encoding the rows that have Unicode input"""
+
+    def __init__(self, f, fieldnames):
+        self.writer = csv.writer(f)
+        self.fieldnames = fieldnames
+
+    def writeheader(self):
+        self.writer.writerow(self.fieldnames)
+
+    def writerow(self, row):
+        try:
+            self.writer.writerow(row)
+        except UnicodeEncodeError:
+            # csv.writer fails before writing anything, so the row can be written again encoded.
+            self.writer.writerow([v.encode('utf-8') if isinstance(v, unicode) else v for v in row])
+
+    def writerows(self, rows):
+        writerow = self.writerow
+        for row in rows:
+            writerow(row)
+
+
+def write_batches(writers, batches, validate, validators, lap):
+    """Validate the batches of rows if asked, write them and empty them"""
+    if validate is True:
+        validate_batches(batches, validators)
+        lap('validate')
+    for writer, batch in zip(writers, batches):
+        writer.writerows(batch)
+        del batch[:]
+    lap('write')
+
+
+def write_dicts(elements, writers, validate, validators, node_sink=None, batch_size=ROW_BATCH_SIZE,
+                metrics=None):
+    """Shape each element to dicts with shape_element and write them in batches"""
+
+    batches = ([], [], [], [], [])
+    nodes, node_tags, ways, way_nodes, way_tags = batches
+    metrics = metrics or Metrics()
+    lap = metrics.lap
+
+    count = 1
+    for element in elements:
+        lap('parse')
+        if count % batch_size == 0:
+            write_batches(writers, batches, validate, validators, lap)
+        count += 1
+        el = shape_element(element)
+        lap('shape')
+        if el:
+            if element.tag == 'node':
+                nodes.append(el['node'])
+                node_tags.extend(el['node_tags'])
+                if node_sink is not None:
+                    node_sink([el['node'][field] for field in NODE_FIELDS])
+                metrics.add('node', len(el['node_tags']))
+            elif element.tag == 'way':
+                ways.append(el['way'])
+                way_nodes.extend(el['way_nodes'])
+                way_tags.extend(el['way_tags'])
+                metrics.add('way', len(el['way_tags']), len(el['way_nodes']))
+            lap('write')
+    write_batches(writers, batches, validate, validators, lap)
+
+
+def write_rows(elements, writers, validate, validators, node_sink=None, batch_size=ROW_BATCH_SIZE,
+               metrics=None):
+    """Shape each element to tuples with shape_element_rows and write them in batches"""
+
+    batches = ([], [], [], [], [])
+    nodes, node_tags, ways, way_nodes, way_tags = batches
+    metrics = metrics or Metrics()
+    lap = metrics.lap
+
+    count = 1
+    for element in elements:
+        lap('parse')
+        if count % batch_size == 0:
+            write_batches(writers, batches, validate, validators, lap)
+        count += 1
+        rows = shape_element_rows(element)
+        lap('shape')
+
+        element_row, tag_rows, way_node_rows = rows
+        if element.tag == 'node':
+            nodes.append(element_row)
+            node_tags.extend(tag_rows)
+            if node_sink is not None:
+                node_sink(element_row)
+            metrics.add('node', len(tag_rows))
+        elif element.tag == 'way':
+            ways.append(element_row)
+            way_nodes.extend(way_node_rows)
+            way_tags.extend(tag_rows)
+            metrics.add('way', len(tag_rows), len(way_node_rows))
+        lap('write')
+    write_batches(writers, batches, validate, validators, lap)
+
+
 # Creating CSV Files.
-def process_map(file_in, validate):
-    """Iteratively process each XML element and write to csv(s)"""
-
-
-    with codecs.open(NODES_PATH, 'w') as nodes_file, \
-         codecs.open(NODE_TAGS_PATH, 'w') as nodes_tags_file, \
-         codecs.open(WAYS_PATH, 'w') as ways_file, \
-         codecs.open(WAY_NODES_PATH, 'w') as way_nodes_file, \
-         codecs.open(WAY_TAGS_PATH, 'w') as way_tags_file:
-
-        nodes_writer = UnicodeDictWriter(nodes_file, NODE_FIELDS)
-        node_tags_writer = UnicodeDictWriter(nodes_tags_file, NODE_TAGS_FIELDS)
-        ways_writer = UnicodeDictWriter(ways_file, WAY_FIELDS)
-        way_nodes_writer = UnicodeDictWriter(way_nodes_file, WAY_NODES_FIELDS)
-        way_tags_writer = UnicodeDictWriter(way_tags_file, WAY_TAGS_FIELDS)
-
-        nodes_writer.writeheader()
-        node_tags_writer.writeheader()
-        ways_writer.writeheader()
-        way_nodes_writer.writeheader()
-        way_tags_writer.writeheader()
-
-        validator = cerberus.Validator()
-
-        count = 1
-        for element in get_element(file_in, tags=('node', 'way')):
-            # Setting a counter to show how many rows the code has processed.
-            if count % 10000 == 0:
-                print (count)
-            count += 1
-            el = shape_element(element)
-            if el:
-                if validate is True:
-                    validate_element(el, validator)
-
-                if element.tag == 'node':
-                    nodes_writer.writerow(el['node'])
-                    node_tags_writer.writerows(el['node_tags'])
-                elif element.tag == 'way':
-                    ways_writer.writerow(el['way'])
-                    way_nodes_writer.writerows(el['way_nodes'])
-                    way_tags_writer.writerows(el['way_tags'])
+def write_csvs(elements, validate, paths=CSV_PATHS, header=True, compact=False, node_store=None,
+               metrics=None, background=False, append=False):
+    """Shape each element, validate it if asked, and write it to the csv(s) in paths
+
+    With compact set, the rows are written as tuples from shape_element_rows in batches
+    instead of one dict per row. The csv(s) are the same either way.
+    If node_store is a directory, the nodes are also written there as a columnar node
+    store that can be memory-mapped, see node_store.py.
+    With background set, each csv is written to disk on a thread of its own while the
+    elements are parsed and shaped, see background_writer.py. The write stage time is
+    then the time spent formatting the rows, plus any wait when the disk falls behind.
+    With append set, the rows are added to the end of the csv(s) instead of replacing them.
+    The stage times and counts are added to metrics, see instrumentation.py."""
+
+    node_writer = None
+    if node_store is not None:
+        # node_store.py needs NumPy, so it is only imported when a node store is written.
+        from node_store import NodeStoreWriter
+        node_writer = NodeStoreWriter(node_store)
+    node_sink = node_writer.add if node_writer is not None else None
+
+    nodes_path, node_tags_path, ways_path, way_nodes_path, way_tags_path = paths
+    mode = 'a' if append else 'w'
+
+    with codecs.open(nodes_path, mode) as nodes_file, \
+         codecs.open(node_tags_path, mode) as nodes_tags_file, \
+         codecs.open(ways_path, mode) as ways_file, \
+         codecs.open(way_nodes_path, mode) as way_nodes_file, \
+         codecs.open(way_tags_path, mode) as way_tags_file:
+
+        files = (nodes_file, nodes_tags_file, ways_file, way_nodes_file, way_tags_file)
+        if background:
+            files = [BackgroundWriter(f, path) for f, path in zip(files, paths)]
+        writer_class = UnicodeRowWriter if compact else UnicodeDictWriter
+        writers = [writer_class(f, fields) for f, fields in zip(files, CSV_FIELDS)]
+
+        if header:
+            for writer in writers:
+                writer.writeheader()
+
+        validators = compile_row_validators(SCHEMA)
+
+        try:
+            if compact:
+                write_rows(elements, writers, validate, validators, node_sink, metrics=metrics)
+            else:
+                write_dicts(elements, writers, validate, validators, node_sink, metrics=metrics)
+        except BaseException:
+            if background:
+                for f in files:
+                    f.abort()
+            raise
+        if background:
+            # Closing waits for the rows still queued, so it counts as writing.
+            for f in files:
+                f.close()
+            if metrics is not None:
+                metrics.lap('write')
+
+    if node_writer is not None:
+        node_writer.close()
+
+
+def process_map(file_in, validate, workers=1, compact=False, node_store=None, metrics=None,
+                backend=None, background=False, checkpoint=None):
+    """Iteratively process each XML element and write to csv(s)
+
+    With workers greater than 1 the file is split into chunks that are converted
+    in parallel by process_map_parallel. With compact set, rows are shaped to tuples
+    instead of dicts, see write_csvs. The csv(s) are the same either way.
+    With node_store set to a directory, a columnar node store is written there too.
+
+    Progress and stage times go to metrics, which by default shows a progress line,
+    see instrumentation.py. Returns the final snapshot of the metrics.
+
+    .gz and .bz2 files are decompressed as they are read, see osm_io.py, and .pbf files
+    are read with pbf_reader.py. They can't be split into chunks, so for them workers is
+    the number of processes used to decompress a multistream bz2 file or to decode the
+    PBF blocks, and the elements are converted here.
+    backend picks the XML parser, see get_element.
+    With background set, the csv(s) are written on background threads, see write_csvs.
+    The parallel conversion doesn't use it, its workers write their chunks locally.
+
+    With checkpoint set to a path, a checkpoint is kept there as the conversion goes, and
+    a conversion that stopped part way carries on from it, see checkpoint.py. That only
+    works for uncompressed .osm files and without a node store."""
+
+    if metrics is None:
+        metrics = Metrics(ProgressSink())
+    metrics.total_bytes = os.path.getsize(file_in)
+    metrics.start()
+
+    if checkpoint is not None:
+        if file_format(file_in) != 'xml':
+            raise ValueError('Only an uncompressed .osm file can be converted with a checkpoint')
+        if node_store is not None:
+            raise ValueError('A node store can\'t be written with a checkpoint')
+        if workers > 1:
+            process_map_parallel(file_in, validate, workers, compact=compact, metrics=metrics,
+                                 backend=backend, checkpoint=checkpoint)
+        else:
+            process_map_segments(file_in, validate, checkpoint, compact=compact, metrics=metrics,
+                                 backend=backend, background=background)
+        return metrics.finish()
+
+    if workers > 1 and file_format(file_in) == 'xml':
+        process_map_parallel(file_in, validate, workers, compact=compact, node_store=node_store,
+                             metrics=metrics, backend=backend)
+        return metrics.finish()
+
+    with closing(open_osm(file_in, workers)) as osm_file:
+        metrics.source = osm_file
+        write_csvs(get_element(osm_file, tags=('node', 'way'), backend=backend), validate,
+                   compact=compact, node_store=node_store, metrics=metrics, background=background)
+    metrics.source = None
+    metrics.offset = metrics.total_bytes
+    return metrics.finish()
+
+
+# ================================================== #
+#            Parallel Conversion Functions           #
+# ================================================== #
+ELEMENT_START = re.compile(br'<(?:node|way|relation)[\s/>]')
+OSM_END = b'</osm>'
+SCAN_SIZE = 1024 * 1024
+
+
+def find_chunk_offsets(file_in, chunks):
+    """Return sorted byte offsets that split file_in into about the given number of
+    chunks. Every offset is the start of a top level element, except the last
+    one which is the position of the closing </osm> tag (or the end of the file)."""
+
+    size = os.path.getsize(file_in)
+    offsets = []
+    with open(file_in, 'rb') as f:
+        for i in range(chunks):
+            # Read forward from the rough split point until an element starts.
+            # Each read overlaps the last one so a tag split between reads is still found.
+            position = size * i // chunks
+            while position < size:
+                f.seek(position)
+                data = f.read(SCAN_SIZE)
+                m = ELEMENT_START.search(data)
+                if m:
+                    offsets.append(position + m.start())
+                    break
+                if len(data) < SCAN_SIZE:
+                    break
+                position += SCAN_SIZE - 16
+
+        f.seek(max(size - SCAN_SIZE, 0))
+        tail = f.read()
+        end = tail.rfind(OSM_END)
+        end = size if end == -1 else size - len(tail) + end
+
+    offsets = sorted(set(o for o in offsets if o < end))
+    offsets.append(end)
+    return offsets
+
+
+def process_chunk(task):
+    """Convert the elements between two byte offsets of file_in into chunk csv(s)"""
+
+    file_in, start, end, validate, paths, header, compact, node_store, backend = task
+    metrics = Metrics()
+    # The chunk is streamed from the file inside a root element of its own, so it is never
+    # all in memory at once.
+    with closing(RangeReader(file_in, start, end)) as chunk:
+        write_csvs(get_element(chunk, tags=('node', 'way'), backend=backend), validate, paths, header,
+                   compact, node_store, metrics)
+    return paths, node_store, end, metrics.totals()
+
+
+def resume_offsets(state, file_in, chunks, metrics):
+    """Load the checkpoint.Checkpoint state and return the offsets splitting the rest of
+    file_in into chunks, like find_chunk_offsets, and whether a checkpoint was carried on
+    from. Its counts and stage times are merged into metrics."""
+
+    start = state.load()
+    offsets = find_chunk_offsets(file_in, chunks)
+    if not start:
+        return offsets, False
+    metrics.merge(state.totals, position=start)
+    return [start] + [offset for offset in offsets if offset > start], True
+
+
+def process_map_segments(file_in, validate, checkpoint, compact=False, metrics=None, backend=None,
+                         background=False, segment_size=SEGMENT_SIZE):
+    """Convert file_in one segment of about segment_size bytes at a time, saving a
+    checkpoint at the path checkpoint after each one, see checkpoint.py"""
+
+    metrics = metrics or Metrics()
+    state = Checkpoint(checkpoint, file_in, CSV_PATHS)
+    offsets, resumed = resume_offsets(state, file_in, os.path.getsize(file_in) // segment_size + 1,
+                                      metrics)
+    if not resumed:
+        # Start the csv(s) with only their headers, every segment is appended to them.
+        write_csvs(iter(()), validate, compact=compact)
+
+    for start, end in zip(offsets, offsets[1:]):
+        with closing(RangeReader(file_in, start, end)) as osm_file:
+            metrics.source = osm_file
+            write_csvs(get_element(osm_file, tags=('node', 'way'), backend=backend), validate,
+                       header=False, compact=compact, metrics=metrics, background=background,
+                       append=True)
+        metrics.source = None
+        state.save(end, metrics.totals())
+    state.remove()
+
+
+def process_map_parallel(file_in, validate, workers, chunks_per_worker=4, compact=False,
+                         node_store=None, metrics=None, backend=None, checkpoint=None):
+    """Split file_in at top level element boundaries and convert the chunks in a
+    process pool. The chunk csv(s) are appended to the final csv(s) in file order,
+    so the output is byte for byte the same as a serial run.
+    The stage times and counts of each chunk are merged into metrics.
+    With checkpoint set, a checkpoint is saved there as each chunk is appended, and the
+    chunks are no bigger than checkpoint.SEGMENT_SIZE, see checkpoint.py."""
+
+    state = None
+    resumed = False
+    if checkpoint is not None:
+        metrics = metrics or Metrics()
+        state = Checkpoint(checkpoint, file_in, CSV_PATHS)
+        chunks = max(workers * chunks_per_worker, os.path.getsize(file_in) // SEGMENT_SIZE + 1)
+        offsets, resumed = resume_offsets(state, file_in, chunks, metrics)
+    else:
+        offsets = find_chunk_offsets(file_in, workers * chunks_per_worker)
+    temp_dir = tempfile.mkdtemp(prefix='osm_chunks_')
+    tasks = []
+    for index, (start, end) in enumerate(zip(offsets, offsets[1:])):
+        paths = tuple(os.path.join(temp_dir, '%05d_%s' % (index, os.path.basename(path)))
+                      for path in CSV_PATHS)
+        chunk_store = os.path.join(temp_dir, '%05d_nodes' % index) if node_store else None
+        # Only the first chunk writes the csv headers.
+        header = index == 0 and not resumed
+        tasks.append((file_in, start, end, validate, paths, header, compact, chunk_store, backend))
+
+    node_writer = None
+    if node_store is not None:
+        from node_store import NodeStoreWriter
+        node_writer = NodeStoreWriter(node_store)
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        outputs = [open(path, 'ab' if resumed else 'wb') for path in CSV_PATHS]
+        try:
+            # imap hands the chunks back in order, so each one can be merged as soon as it is done.
+            for paths, chunk_store, end, totals in pool.imap(process_chunk, tasks):
+                for output, path in zip(outputs, paths):
+                    with open(path, 'rb') as chunk_file:
+                        shutil.copyfileobj(chunk_file, output)
+                    os.remove(path)
+                if node_writer is not None:
+                    node_writer.append_store(chunk_store)
+                    shutil.rmtree(chunk_store)
+                if metrics is not None:
+                    metrics.merge(totals, position=end)
+                if state is not None:
+                    for output in outputs:
+                        output.flush()
+                    state.save(end, metrics.totals())
+        finally:
+            for output in outputs:
+                output.close()
+            if node_writer is not None:
+                node_writer.close()
+        pool.close()
+        if state is not None:
+            state.remove()
+    finally:
+        pool.terminate()
+        pool.join()
+        shutil.rmtree(temp_dir, ignore_errors=True)
 
 if __name__ == '__main__':
-    # Note: If the validation is set to True,
-    # the process takes much longer than when it is set to False.
-    process_map(OSM_PATH, validate=True)
\ No newline at end of file
+    # Note: Validation uses the schema compiled by schema_compiler.py, so it
+    # only adds a small amount of time and can be left set to True.
+    # Set workers to the number of cores to convert large files in parallel.
+    # Pass checkpoint=checkpoint.CHECKPOINT_PATH to be able to resume a conversion that stopped.
+    process_map(OSM_PATH, validate=True, workers=1)
\ No newline at end of file
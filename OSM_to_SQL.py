@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Loads the OSM XML file straight into the SQLite database, without writing the csv files first.
+
+OSM_to_CSV.py writes five csv files that creating_db.py then reads back in to fill the tables.
+Here each element is shaped with shape_element_rows, which gives tuples in the same column
+order as the csv files, and the tuples are inserted with executemany in large batches, so the data is only serialized once.
+
+While loading, the database is switched to bulk load settings (rollback journal in memory,
+no syncing to disk and a large page cache). The safe settings are put back once the load
+is done, even if it fails part way through.
+"""
+
+import sqlite3
+from contextlib import contextmanager
+
+from indexes import build_indexes, check_query_plans
+from spatial import build_spatial_index
+from summary import build_summary_tables
+from compact_schema import (TagEncoder, is_compact, create_compact_schema, drop_compact_schema,
+                            compact_insert_sql, COMPACT_TABLE_INDEXES)
+from query_cache import bump_version
+from OSM_to_CSV import (get_element, shape_element_rows, compile_row_validators, validate_rows, SCHEMA,
+                        NODE_FIELDS, NODE_TAGS_FIELDS, WAY_FIELDS, WAY_TAGS_FIELDS, WAY_NODES_FIELDS)
+
+OSM_PATH = "sample1percent.osm"
+DB_PATH = "osm_stchas.sqlite"
+
+BATCH_SIZE = 50000
+
+# The tables of the database, in the order they are loaded. creating_db.py uses them too.
+# The primary keys of nodes and ways are added as unique indexes once the data is loaded,
+# see TABLE_INDEXES, since building an index in one go is much faster than updating it per row.
+TABLES = [
+    ('nodes', NODE_FIELDS, '''
+        CREATE TABLE IF NOT EXISTS nodes(id VARCHAR, lat REAL,
+        lon REAL, user TEXT, uid INTEGER, version TEXT, changeset INTEGER, timestamp DATE)
+    '''),
+    ('nodes_tags', NODE_TAGS_FIELDS, '''
+        CREATE TABLE IF NOT EXISTS nodes_tags(id INTEGER, key TEXT, value TEXT, type TEXT)
+    '''),
+    ('ways', WAY_FIELDS, '''
+        CREATE TABLE IF NOT EXISTS ways(id VARCHAR, user TEXT, uid INTEGER,
+        version VARCHAR, changeset INTEGER, timestamp DATETIME)
+    '''),
+    ('ways_nodes', WAY_NODES_FIELDS, '''
+        CREATE TABLE IF NOT EXISTS ways_nodes(id INTEGER, node_id INTEGER, position INTEGER)
+    '''),
+    ('ways_tags', WAY_TAGS_FIELDS, '''
+        CREATE TABLE IF NOT EXISTS ways_tags(id INTEGER , key TEXT, value TEXT, type TEXT)
+    '''),
+]
+
+TABLE_INDEXES = [
+    'CREATE UNIQUE INDEX IF NOT EXISTS nodes_id ON nodes(id)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS ways_id ON ways(id)',
+    # Used to find an element's tags when apply_osc.py replaces or deletes it.
+    'CREATE INDEX IF NOT EXISTS nodes_tags_id ON nodes_tags(id)',
+    'CREATE INDEX IF NOT EXISTS ways_tags_id ON ways_tags(id)',
+]
+
+BULK_LOAD_PRAGMAS = [('journal_mode', 'MEMORY'), ('synchronous', 'OFF'), ('cache_size', -200000)]
+SAFE_PRAGMAS = [('journal_mode', 'DELETE'), ('synchronous', 'FULL'), ('cache_size', -2000)]
+
+
+def set_pragmas(con, pragmas):
+    """Apply a list of (name, value) PRAGMA settings to the connection"""
+    for name, value in pragmas:
+        con.execute('PRAGMA %s = %s' % (name, value))
+
+
+@contextmanager
+def bulk_load_settings(con):
+    """Use the bulk load settings inside the with block and restore the safe ones after it"""
+    con.commit()
+    set_pragmas(con, BULK_LOAD_PRAGMAS)
+    try:
+        yield con
+    finally:
+        # The journal mode can't be changed inside a transaction.
+        con.rollback()
+        set_pragmas(con, SAFE_PRAGMAS)
+
+
+def create_tables(con, compact_schema=False):
+    """Drop the tables if they exist already and create them empty.
+    With compact_schema set, the tables are created as in compact_schema.py."""
+    drop_compact_schema(con)
+    for table, fields, create_sql in TABLES:
+        con.execute('DROP TABLE IF EXISTS %s' % table)
+        if not compact_schema or table == 'ways_nodes':
+            con.execute(create_sql)
+    if compact_schema:
+        create_compact_schema(con)
+    con.commit()
+
+
+def create_indexes(con):
+    """Build the indexes and unique constraints of the tables once they are loaded"""
+    for create_sql in COMPACT_TABLE_INDEXES if is_compact(con) else TABLE_INDEXES:
+        con.execute(create_sql)
+    con.commit()
+
+
+def insert_sql(table, fields):
+    return 'INSERT INTO %s(%s) VALUES(%s);' % (table, ', '.join(fields), ', '.join('?' * len(fields)))
+
+
+def load_map(file_in, db=DB_PATH, validate=True, batch_size=BATCH_SIZE, compact_schema=False):
+    """Shape each element of file_in and insert it straight into the database tables.
+    With compact_schema set, the strings are interned as in compact_schema.py.
+    Returns a dict of the number of rows inserted into each table."""
+
+    con = sqlite3.connect(db)
+    con.text_factory = str
+    fields = dict((table, table_fields) for table, table_fields, _ in TABLES)
+    encoder = TagEncoder() if compact_schema else None
+    make_sql = compact_insert_sql if compact_schema else insert_sql
+    statements = dict((table, make_sql(table, fields[table])) for table in fields)
+    batches = dict((table, []) for table in fields)
+    counts = dict((table, 0) for table in fields)
+    validators = compile_row_validators(SCHEMA)
+
+    def add(table, rows):
+        batch = batches[table]
+        batch.extend(rows)
+        if len(batch) >= batch_size:
+            flush(table)
+
+    def flush(table):
+        rows = batches[table]
+        if validate is True:
+            validate_rows(table, rows, validators)
+        if encoder is not None:
+            rows = encoder.encode(table, rows)
+            encoder.flush(con)
+        con.executemany(statements[table], rows)
+        counts[table] += len(rows)
+        del batches[table][:]
+
+    try:
+        with bulk_load_settings(con):
+            create_tables(con, compact_schema)
+            for element in get_element(file_in, tags=('node', 'way')):
+                element_row, tag_rows, way_node_rows = shape_element_rows(element)
+                if element.tag == 'node':
+                    add('nodes', [element_row])
+                    add('nodes_tags', tag_rows)
+                else:
+                    add('ways', [element_row])
+                    add('ways_nodes', way_node_rows)
+                    add('ways_tags', tag_rows)
+
+            for table in batches:
+                flush(table)
+            con.commit()
+            create_indexes(con)
+            build_indexes(con)
+            build_summary_tables(con)
+            check_query_plans(con)
+            build_spatial_index(con)
+            bump_version(con)
+            con.commit()
+    finally:
+        con.close()
+    return counts
+
+
+if __name__ == '__main__':
+    print(load_map(OSM_PATH, DB_PATH, validate=True))
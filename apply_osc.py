@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Applies an osmChange (.osc) diff to the SQLite database instead of rebuilding it.
+
+An osmChange file holds <create>, <modify> and <delete> blocks of nodes and ways. Each
+node and way is cleaned with the same shape_element_rows used by OSM_to_SQL.py, then its
+old rows are deleted from the tables and the new ones inserted, and the spatial index from
+spatial.py and the ways_geometry table from way_geometry.py are updated. A change is only applied
+if its version is newer than the version already in the database, so replaying an old
+diff does nothing. The whole diff is applied in one transaction, so the time it takes
+depends on the size of the diff and not the size of the region.
+
+The diff can also be gzip or bzip2 compressed, like the .osc.gz replication diffs.
+
+Usage: python apply_osc.py changes.osc[.gz] [osm_stchas.sqlite]
+"""
+
+import sqlite3
+import sys
+import xml.etree.cElementTree as ET
+from contextlib import closing
+
+from osm_io import open_osm
+from OSM_to_CSV import shape_element_rows, compile_row_validators, validate_element_rows, SCHEMA
+from OSM_to_SQL import TABLES, DB_PATH, create_indexes, insert_sql
+from spatial import has_spatial_index, refresh_element
+from way_geometry import has_way_geometry, update_way_geometry
+from query_cache import bump_version
+
+ACTIONS = ('create', 'modify', 'delete')
+
+# The tables each element type has rows in. The first one holds the element itself.
+ELEMENT_TABLES = {
+    'node': ('nodes', 'nodes_tags'),
+    'way': ('ways', 'ways_tags', 'ways_nodes'),
+}
+
+
+def get_changes(osc_file):
+    """Yield (action, element) for every node and way in the osmChange file.
+    .osc.gz and .osc.bz2 files are decompressed as they are read."""
+
+    with closing(open_osm(osc_file)) as source:
+        context = ET.iterparse(source, events=('start', 'end'))
+        action = None
+        block = None
+        for event, elem in context:
+            if event == 'start' and elem.tag in ACTIONS:
+                action, block = elem.tag, elem
+            elif event == 'end' and elem.tag in ('node', 'way') and block is not None:
+                yield action, elem
+                # Drop the elements that have been applied so memory use stays flat.
+                block.clear()
+            elif event == 'end' and elem.tag in ACTIONS:
+                action = block = None
+
+
+def stored_version(con, table, element_id):
+    """Return the version of the element in the database, or None if it isn't there"""
+    row = con.execute('SELECT version FROM %s WHERE id = ?' % table, (element_id,)).fetchone()
+    return None if row is None else int(row[0])
+
+
+def delete_element(con, tag, element_id):
+    for table in ELEMENT_TABLES[tag]:
+        con.execute('DELETE FROM %s WHERE id = ?' % table, (element_id,))
+
+
+def insert_element(con, tag, rows, statements):
+    element_row, tag_rows, way_node_rows = rows
+    if tag == 'node':
+        con.execute(statements['nodes'], element_row)
+        con.executemany(statements['nodes_tags'], tag_rows)
+    else:
+        con.execute(statements['ways'], element_row)
+        con.executemany(statements['ways_tags'], tag_rows)
+        con.executemany(statements['ways_nodes'], way_node_rows)
+
+
+def apply_change(osc_file, db=DB_PATH, validate=True):
+    """Apply every change in osc_file to the database in a single transaction.
+    Returns a dict counting the changes applied per action, and the stale ones skipped."""
+
+    con = sqlite3.connect(db)
+    con.text_factory = str
+    statements = dict((table, insert_sql(table, fields)) for table, fields, _ in TABLES)
+    validators = compile_row_validators(SCHEMA)
+    counts = dict((action, 0) for action in ACTIONS + ('stale',))
+
+    try:
+        # Deleting an element's old rows looks them up by id, so make sure the indexes exist.
+        create_indexes(con)
+        spatial_index = has_spatial_index(con)
+        geometry = has_way_geometry(con)
+        changed_ways = set()
+
+        for action, element in get_changes(osc_file):
+            element_id = element.attrib['id']
+            version = int(element.attrib.get('version', 0))
+            current = stored_version(con, ELEMENT_TABLES[element.tag][0], element_id)
+            # Skip changes older than what is stored, and deletes of elements already gone.
+            if (current is not None and current >= version) or (current is None and action == 'delete'):
+                counts['stale'] += 1
+                continue
+
+            delete_element(con, element.tag, element_id)
+            if action != 'delete':
+                rows = shape_element_rows(element)
+                if validate is True:
+                    validate_element_rows(element.tag, rows, validators)
+                insert_element(con, element.tag, rows, statements)
+            if spatial_index:
+                refresh_element(con, element.tag, element_id)
+            if geometry and element.tag == 'way':
+                changed_ways.add(element_id)
+            elif geometry:
+                changed_ways.update(way_id for way_id, in con.execute(
+                    'SELECT id FROM ways_nodes WHERE node_id = ?', (element_id,)))
+            counts[action] += 1
+
+        if changed_ways:
+            update_way_geometry(con, changed_ways)
+        if any(counts[action] for action in ACTIONS):
+            bump_version(con)
+        con.commit()
+    except:
+        con.rollback()
+        raise
+    finally:
+        con.close()
+    return counts
+
+
+if __name__ == '__main__':
+    osc_path = sys.argv[1]
+    db_path = sys.argv[2] if len(sys.argv) > 2 else DB_PATH
+    print(apply_change(osc_path, db_path))
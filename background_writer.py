@@ -0,0 +1,98 @@
+"""Writing the csv files on background threads, so the parser doesn't wait on the disk.
+
+A BackgroundWriter stands in for an open file. The csv writers in OSM_to_CSV.py write
+their rows to it as usual, it collects them into chunks of about chunk_size bytes, and
+each full chunk is put on a bounded queue that a thread of its own takes them from and
+writes to the real file. Formatting the rows stays on the main thread, and the thread
+spends its time in file.write, which doesn't hold the GIL, so parsing and shaping go on
+while the disk is busy. That matters most when the output is on slow or network mounted
+storage.
+
+The queue holds at most queue_size chunks. When the disk can't keep up, the main thread
+blocks on the queue until a chunk has been written, so the memory used stays bounded.
+
+An error in the thread is kept and raised as a WriterError in the main thread the next
+time a chunk is put or when the writer is closed. The thread keeps taking chunks from the
+queue after an error, without writing them, so the main thread never blocks on a full
+queue.
+"""
+
+import threading
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+# Bytes collected before a chunk is handed to the thread.
+CHUNK_SIZE = 1024 * 1024
+
+# Chunks that can wait in the queue of each writer.
+QUEUE_SIZE = 8
+
+
+class WriterError(Exception):
+    """Raised in the main thread when a background writer failed"""
+
+
+class BackgroundWriter(object):
+    """Writes to output on a thread, see the module docstring"""
+
+    def __init__(self, output, name=None, chunk_size=CHUNK_SIZE, queue_size=QUEUE_SIZE):
+        self.output = output
+        self.name = name or getattr(output, 'name', repr(output))
+        self.chunk_size = chunk_size
+        self.pieces = []
+        self.size = 0
+        self.queue = Queue(queue_size)
+        self.error = None
+        self.aborted = False
+        self.thread = threading.Thread(target=self.run, name='writer %s' % self.name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                break
+            if self.error is not None or self.aborted:
+                continue
+            try:
+                self.output.write(chunk)
+            except Exception as e:
+                self.error = e
+
+    def check(self):
+        """Raise WriterError if the thread failed"""
+        if self.error is not None:
+            raise WriterError('Writing %s failed: %s' % (self.name, self.error))
+
+    def put(self):
+        self.check()
+        if self.pieces:
+            self.queue.put(''.join(self.pieces))
+            self.pieces = []
+            self.size = 0
+
+    def write(self, data):
+        self.pieces.append(data)
+        self.size += len(data)
+        if self.size >= self.chunk_size:
+            self.put()
+
+    def close(self):
+        """Write what is still waiting, wait for the thread to finish and raise
+        WriterError if anything failed. The output itself is left open."""
+        self.put()
+        self.queue.put(None)
+        self.thread.join()
+        self.check()
+
+    def abort(self):
+        """Stop the thread without writing what is still waiting, e.g. after the
+        conversion failed. Errors in the thread are not raised."""
+        self.aborted = True
+        self.pieces = []
+        self.queue.put(None)
+        self.thread.join()
@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks every stage of the pipeline on a synthetic OSM file of any size.
+
+The only real data is sample1percent.osm, which is too small to show how the code
+behaves on the full region or bigger. generate_osm writes a deterministic synthetic
+file of about the size asked for (10MB up to several GB) by scaling up the sample:
+every node and way copies the attributes and tags of a random element of the sample,
+so the mix of tags, the dirty street names, postcodes and cities, and the number of
+nodes per way all follow the sample. Nodes get new sequential ids and a location near
+the one they copied, and ways refer to nearby generated nodes. The same seed and size
+always give the same file.
+
+The stages timed are Audit.audit_s, audit_p and audit_C, OSM_to_CSV.process_map with
+and without validation, creating_db.create_db, and each query in queries.REPORT_QUERIES.
+Throughput is reported in elements/sec and MB/sec of the input file, and the results
+are written to a JSON file along with the git commit, so runs on different commits can
+be compared with --compare.
+
+Usage: python benchmark.py --size 100MB [--output results.json] [--compare old.json]
+"""
+
+from __future__ import print_function
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from xml.sax.saxutils import quoteattr
+
+import Audit
+import creating_db
+import OSM_to_CSV
+from queries import REPORT_QUERIES
+
+SAMPLE_PATH = 'sample1percent.osm'
+DB_NAME = 'osm_stchas.sqlite'
+
+DEFAULT_SIZE = '10MB'
+DEFAULT_SEED = 42
+
+# How far, in degrees, a generated node can be moved from the node it copies.
+JITTER = 0.0005
+
+# How far back, in generated nodes, a way looks for the nodes it uses.
+REF_WINDOW = 5000
+
+# How many times each query is run. The fastest run is reported.
+QUERY_REPEAT = 5
+
+STAGES = ('audit_s', 'audit_p', 'audit_C', 'process_map', 'process_map_validate',
+          'create_db', 'queries')
+
+NODE_ATTRIBS = ('id', 'lat', 'lon', 'version', 'timestamp', 'changeset', 'uid', 'user')
+WAY_ATTRIBS = ('id', 'version', 'timestamp', 'changeset', 'uid', 'user')
+
+SIZE_RE = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([kmg]?)b?\s*$', re.IGNORECASE)
+SIZE_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+
+def parse_size(size):
+    """Turn a size like '500MB' or '2GB' into bytes"""
+    m = SIZE_RE.match(size)
+    if not m:
+        raise ValueError('Size must look like 10MB or 2GB: %r' % size)
+    return int(float(m.group(1)) * SIZE_UNITS[m.group(2).lower()])
+
+
+def text(value):
+    """Return value as unicode, ElementTree gives plain str for ascii values on Python 2"""
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+# ================================================== #
+#              Synthetic OSM Generator               #
+# ================================================== #
+def profile_osm(sample_path=SAMPLE_PATH):
+    """Read the nodes and ways of the sample into templates for generate_osm.
+
+    Returns a dict with the node templates (attributes and tags), the way templates
+    (attributes, tags, number of nd refs and whether the way is closed) and the
+    size of the sample in bytes."""
+    nodes = []
+    ways = []
+    for element in OSM_to_CSV.get_element(sample_path, tags=('node', 'way')):
+        attrib = dict((k, text(v)) for k, v in element.attrib.items())
+        tags = [(text(tag.attrib['k']), text(tag.attrib['v'])) for tag in element.iter('tag')]
+        if element.tag == 'node':
+            nodes.append((attrib, tags))
+        else:
+            refs = [nd.attrib['ref'] for nd in element.iter('nd')]
+            closed = len(refs) > 2 and refs[0] == refs[-1]
+            ways.append((attrib, tags, len(refs), closed))
+    return {'nodes': nodes, 'ways': ways, 'bytes': os.path.getsize(sample_path)}
+
+
+def element_xml(tag, attrib, names, tags, refs=()):
+    """Return the OSM XML of one element, laid out like the sample"""
+    attribs = ' '.join('%s=%s' % (name, quoteattr(attrib[name])) for name in names if name in attrib)
+    children = ['    <nd ref="%d" />\n' % ref for ref in refs]
+    children.extend('    <tag k=%s v=%s />\n' % (quoteattr(k), quoteattr(v)) for k, v in tags)
+    if not children:
+        return u'  <%s %s />\n' % (tag, attribs)
+    return u'  <%s %s>\n%s  </%s>\n' % (tag, attribs, ''.join(children), tag)
+
+
+def generate_osm(path, size, seed=DEFAULT_SEED, sample_path=SAMPLE_PATH, profile=None):
+    """Write a synthetic OSM file of about size bytes to path, see the module docstring.
+    Returns a dict describing the file, with the number of nodes and ways written."""
+    profile = profile or profile_osm(sample_path)
+    scale = float(size) / profile['bytes']
+    node_count = max(1, int(round(len(profile['nodes']) * scale)))
+    way_count = int(round(len(profile['ways']) * scale))
+    rng = random.Random(seed)
+
+    with io.open(path, 'w', encoding='utf-8') as f:
+        f.write(u'<?xml version="1.0" encoding="UTF-8"?>\n<osm>\n')
+
+        for node_id in range(1, node_count + 1):
+            attrib, tags = rng.choice(profile['nodes'])
+            attrib = dict(attrib)
+            attrib['id'] = str(node_id)
+            attrib['lat'] = '%.7f' % (float(attrib['lat']) + rng.uniform(-JITTER, JITTER))
+            attrib['lon'] = '%.7f' % (float(attrib['lon']) + rng.uniform(-JITTER, JITTER))
+            f.write(element_xml('node', attrib, NODE_ATTRIBS, tags))
+
+        for way_number in range(way_count):
+            attrib, tags, ref_count, closed = rng.choice(profile['ways'])
+            attrib = dict(attrib)
+            attrib['id'] = str(node_count + way_number + 1)
+            # Ways are spread over the nodes in file order and use a run of nearby nodes.
+            anchor = 1 + (way_number * node_count) // max(way_count, 1)
+            start = max(1, anchor - rng.randint(0, REF_WINDOW))
+            refs = [min(node_count, start + i) for i in range(ref_count - 1 if closed else ref_count)]
+            if closed:
+                refs.append(refs[0])
+            f.write(element_xml('way', attrib, WAY_ATTRIBS, tags, refs))
+
+        f.write(u'</osm>\n')
+
+    return {'path': path, 'bytes': os.path.getsize(path), 'nodes': node_count,
+            'ways': way_count, 'seed': seed, 'synthetic': True}
+
+
+def describe_osm(path):
+    """Count the nodes and ways of an existing OSM file"""
+    counts = {'node': 0, 'way': 0}
+    for element in OSM_to_CSV.get_element(path, tags=('node', 'way')):
+        counts[element.tag] += 1
+    return {'path': path, 'bytes': os.path.getsize(path), 'nodes': counts['node'],
+            'ways': counts['way'], 'seed': None, 'synthetic': False}
+
+
+# ================================================== #
+#                     Benchmarks                     #
+# ================================================== #
+def timed(func, *args, **kwargs):
+    """Return (seconds, result) of one call"""
+    start = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - start, result
+
+
+def throughput(stage, seconds, elements, input_bytes):
+    return {
+        'stage': stage,
+        'seconds': round(seconds, 6),
+        'elements': elements,
+        'elements_per_sec': round(elements / max(seconds, 1e-9), 1),
+        'mb_per_sec': round(input_bytes / (1024.0 * 1024.0) / max(seconds, 1e-9), 3),
+    }
+
+
+def run_queries(db_path, repeat=QUERY_REPEAT):
+    con = sqlite3.connect(db_path)
+    results = []
+    try:
+        for name in sorted(REPORT_QUERIES):
+            best = None
+            for _ in range(repeat):
+                seconds, rows = timed(lambda: con.execute(REPORT_QUERIES[name]).fetchall())
+                best = seconds if best is None else min(best, seconds)
+            results.append({'stage': 'query:' + name, 'seconds': round(best, 6), 'rows': len(rows)})
+    finally:
+        con.close()
+    return results
+
+
+def run_benchmarks(osm_info, work_dir, stages=STAGES, repeat=QUERY_REPEAT):
+    """Run the stages on the OSM file described by osm_info, writing the csv(s) and the
+    database to work_dir. Returns a list of result dicts, one per stage and query."""
+    osm_path = os.path.abspath(osm_info['path'])
+    input_bytes = osm_info['bytes']
+    elements = osm_info['nodes'] + osm_info['ways']
+    results = []
+
+    def report(result):
+        results.append(result)
+        line = '%-40s %10.3fs' % (result['stage'], result['seconds'])
+        if 'elements_per_sec' in result:
+            line += ' %12.0f elements/s %8.2f MB/s' % (result['elements_per_sec'], result['mb_per_sec'])
+        print(line)
+
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        for name in ('audit_s', 'audit_p', 'audit_C'):
+            if name in stages:
+                seconds, _ = timed(getattr(Audit, name), osm_path)
+                report(throughput(name, seconds, elements, input_bytes))
+
+        if 'process_map' in stages:
+            seconds, _ = timed(OSM_to_CSV.process_map, osm_path, validate=False)
+            report(throughput('process_map', seconds, elements, input_bytes))
+
+        # The database stages need the csv(s), and the queries need the database.
+        needs_db = 'create_db' in stages or 'queries' in stages
+        if 'process_map_validate' in stages or (needs_db and not os.path.exists(OSM_to_CSV.NODES_PATH)):
+            seconds, _ = timed(OSM_to_CSV.process_map, osm_path, validate=True)
+            if 'process_map_validate' in stages:
+                report(throughput('process_map_validate', seconds, elements, input_bytes))
+
+        if needs_db:
+            seconds, _ = timed(creating_db.create_db, DB_NAME)
+            if 'create_db' in stages:
+                report(throughput('create_db', seconds, elements, input_bytes))
+
+        if 'queries' in stages:
+            for result in run_queries(DB_NAME, repeat):
+                report(result)
+    finally:
+        os.chdir(cwd)
+    return results
+
+
+def git_commit():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=devnull,
+                                           cwd=os.path.dirname(os.path.abspath(__file__))).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old_results, new_results):
+    """Print how the time of each stage changed between two result files"""
+    old = dict((r['stage'], r['seconds']) for r in old_results['results'])
+    print('%-40s %10s %10s %8s' % ('stage', 'old', 'new', 'speedup'))
+    for result in new_results['results']:
+        stage = result['stage']
+        if stage in old:
+            print('%-40s %9.3fs %9.3fs %7.2fx' % (stage, old[stage], result['seconds'],
+                                                   old[stage] / max(result['seconds'], 1e-9)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the OSM pipeline on a synthetic file.')
+    parser.add_argument('--size', default=DEFAULT_SIZE, help='size of the synthetic file, e.g. 10MB or 2GB')
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument('--sample', default=SAMPLE_PATH, help='OSM file the synthetic file is modelled on')
+    parser.add_argument('--input', help='benchmark this OSM file instead of generating one')
+    parser.add_argument('--stages', default=','.join(STAGES),
+                        help='comma separated stages to run, from: %s' % ', '.join(STAGES))
+    parser.add_argument('--repeat', type=int, default=QUERY_REPEAT, help='runs of each query')
+    parser.add_argument('--output', help='JSON file for the results (default benchmark_<time>.json)')
+    parser.add_argument('--compare', help='earlier JSON results to compare this run against')
+    parser.add_argument('--keep', action='store_true', help='keep the generated file, csv(s) and database')
+    args = parser.parse_args(argv)
+
+    stages = [stage.strip() for stage in args.stages.split(',') if stage.strip()]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error('unknown stages: %s' % ', '.join(sorted(unknown)))
+
+    work_dir = tempfile.mkdtemp(prefix='osm_benchmark_')
+    try:
+        if args.input:
+            osm_info = describe_osm(args.input)
+        else:
+            seconds, osm_info = timed(generate_osm, os.path.join(work_dir, 'synthetic.osm'),
+                                      parse_size(args.size), args.seed, args.sample)
+            print('Generated %(bytes)d bytes, %(nodes)d nodes and %(ways)d ways' % osm_info
+                  + ' in %.1f seconds' % seconds)
+
+        results = {
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'input': osm_info,
+            'results': run_benchmarks(osm_info, work_dir, stages, args.repeat),
+        }
+    finally:
+        if args.keep:
+            print('Kept %s' % work_dir)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = args.output or 'benchmark_%s.json' % time.strftime('%Y%m%d_%H%M%S')
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print('Results written to %s' % output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
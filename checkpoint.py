@@ -0,0 +1,97 @@
+"""Checkpoints that let a conversion by OSM_to_CSV.process_map carry on after it stopped.
+
+Given a checkpoint path, process_map converts an uncompressed .osm file one segment of
+about SEGMENT_SIZE bytes at a time. Each segment starts and ends at a top level element,
+found the same way as the chunks of the parallel conversion. When a segment's rows are in
+the csv files, the files are synced to disk and the checkpoint is written. It holds the
+byte offset where the next segment starts, the element and row counts so far (see
+instrumentation.py) and the length of each csv file.
+
+The conversion can stop part way, for example when validation rejects a bad
+element or the process is killed. Running it again with the same checkpoint truncates
+each csv to the length in the checkpoint, which drops the rows of the unfinished segment.
+It then goes on parsing from the saved offset. The csv(s) come out the same as from a run
+that never stopped. With workers, the segments are the chunks of the parallel conversion,
+and a checkpoint is written as each one is merged in. The checkpoint is removed once the
+conversion is done.
+
+A checkpoint is only used for the same input file, with the same size and modification
+time, and the same csv paths, and only if none of the csv files is shorter than
+recorded. Otherwise the conversion starts from the beginning.
+"""
+
+import json
+import os
+
+CHECKPOINT_PATH = 'osm_to_csv.checkpoint.json'
+
+# Bytes of the input converted between checkpoints.
+SEGMENT_SIZE = 64 * 1024 * 1024
+
+
+def sync_file(path):
+    """Make sure what has been written to the file at path is on disk"""
+    with open(path, 'rb') as f:
+        os.fsync(f.fileno())
+
+
+class Checkpoint(object):
+    """The checkpoint at path of converting file_in to the csv files in paths"""
+
+    def __init__(self, path, file_in, paths):
+        self.path = path
+        self.paths = list(paths)
+        stat = os.stat(file_in)
+        self.source = {'file': os.path.abspath(file_in), 'size': stat.st_size, 'mtime': stat.st_mtime}
+        self.offset = 0
+        self.totals = None
+
+    def load(self):
+        """Read the checkpoint and truncate the csv files to it. Returns the byte offset
+        to carry on from, or 0 if there is no usable checkpoint."""
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError):
+            return 0
+        if state.get('source') != self.source or state.get('paths') != self.paths:
+            return 0
+        sizes = state['sizes']
+        for path, size in zip(self.paths, sizes):
+            if not os.path.exists(path) or os.path.getsize(path) < size:
+                return 0
+        for path, size in zip(self.paths, sizes):
+            with open(path, 'r+b') as f:
+                f.truncate(size)
+        self.offset = state['offset']
+        self.totals = state['totals']
+        return self.offset
+
+    def save(self, offset, totals):
+        """Record that the input up to offset is in the csv files, with the counts and
+        stage times in totals (Metrics.totals)"""
+        for path in self.paths:
+            sync_file(path)
+        state = {
+            'source': self.source,
+            'paths': self.paths,
+            'sizes': [os.path.getsize(path) for path in self.paths],
+            'offset': offset,
+            'totals': totals,
+        }
+        # Written to a new file and renamed over the old one, so a checkpoint is never
+        # left half written.
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.name == 'nt' and os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(temp_path, self.path)
+        self.offset = offset
+        self.totals = totals
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
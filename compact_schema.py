@@ -0,0 +1,234 @@
+"""An optional compact schema that stores the repeated strings of the tables once.
+
+Every nodes_tags and ways_tags row repeats its key and type, and often its value, as
+text, and every nodes and ways row repeats the user name. In the compact schema these
+strings are interned into lookup tables with integer ids:
+
+- tag_keys, tag_types and users hold every key, type and user name.
+- tag_values holds the values of low-cardinality keys, like amenity or highway. The first
+  VALUE_LIMIT distinct values of each key are interned. After that the key's new values
+  are stored as text on the tag row, since a name or a house number is rarely repeated.
+
+The rows themselves go into compact_nodes, compact_nodes_tags, compact_ways and
+compact_ways_tags, which hold the ids. ways_nodes is all numbers already and is left as
+it is. Views named nodes, nodes_tags, ways and ways_tags join the ids back to the strings,
+with the same columns as the normal tables, so queries.py, spatial.py and the other
+scripts read them unchanged. INSTEAD OF triggers on the views intern the strings of rows
+inserted into them and delete the rows deleted from them, which is all apply_osc.py
+does. Rows can't be updated through the views.
+
+TagEncoder assigns the ids while the loaders stream the rows, and keeps the new lookup
+rows until they are written with flush. Pass compact_schema=True to
+creating_db.create_db or OSM_to_SQL.load_map to load a database this way.
+"""
+
+# Distinct values of a key that are interned into tag_values.
+VALUE_LIMIT = 256
+
+LOOKUP_TABLES = [
+    ('tag_keys', 'key'),
+    ('tag_types', 'type'),
+    ('tag_values', 'value'),
+    ('users', 'user'),
+]
+
+# The normal table each compact table stands in for, its columns and how to create it.
+COMPACT_TABLES = [
+    ('nodes', 'compact_nodes',
+     ('id', 'lat', 'lon', 'user_id', 'uid', 'version', 'changeset', 'timestamp'), '''
+        CREATE TABLE compact_nodes(id VARCHAR, lat REAL, lon REAL, user_id INTEGER, uid INTEGER,
+        version TEXT, changeset INTEGER, timestamp DATE)
+    '''),
+    ('nodes_tags', 'compact_nodes_tags', ('id', 'key_id', 'value_id', 'value', 'type_id'), '''
+        CREATE TABLE compact_nodes_tags(id INTEGER, key_id INTEGER, value_id INTEGER,
+        value TEXT, type_id INTEGER)
+    '''),
+    ('ways', 'compact_ways', ('id', 'user_id', 'uid', 'version', 'changeset', 'timestamp'), '''
+        CREATE TABLE compact_ways(id VARCHAR, user_id INTEGER, uid INTEGER, version VARCHAR,
+        changeset INTEGER, timestamp DATETIME)
+    '''),
+    ('ways_tags', 'compact_ways_tags', ('id', 'key_id', 'value_id', 'value', 'type_id'), '''
+        CREATE TABLE compact_ways_tags(id INTEGER, key_id INTEGER, value_id INTEGER,
+        value TEXT, type_id INTEGER)
+    '''),
+]
+
+COMPACT_FIELDS = dict((table, (compact, fields)) for table, compact, fields, _ in COMPACT_TABLES)
+
+# The views of the element tables, and the triggers that intern the user of inserted rows.
+ELEMENT_VIEWS = {
+    'nodes': '''
+        CREATE VIEW nodes AS
+        SELECT n.id, n.lat, n.lon, u.user, n.uid, n.version, n.changeset, n.timestamp
+        FROM compact_nodes n LEFT JOIN users u ON u.id = n.user_id;
+
+        CREATE TRIGGER nodes_insert INSTEAD OF INSERT ON nodes BEGIN
+            INSERT OR IGNORE INTO users(user) VALUES (NEW.user);
+            INSERT INTO compact_nodes VALUES (NEW.id, NEW.lat, NEW.lon,
+                (SELECT id FROM users WHERE user = NEW.user), NEW.uid, NEW.version,
+                NEW.changeset, NEW.timestamp);
+        END;
+    ''',
+    'ways': '''
+        CREATE VIEW ways AS
+        SELECT w.id, u.user, w.uid, w.version, w.changeset, w.timestamp
+        FROM compact_ways w LEFT JOIN users u ON u.id = w.user_id;
+
+        CREATE TRIGGER ways_insert INSTEAD OF INSERT ON ways BEGIN
+            INSERT OR IGNORE INTO users(user) VALUES (NEW.user);
+            INSERT INTO compact_ways VALUES (NEW.id,
+                (SELECT id FROM users WHERE user = NEW.user), NEW.uid, NEW.version,
+                NEW.changeset, NEW.timestamp);
+        END;
+    ''',
+}
+
+# Filled in with the normal and compact table names.
+ELEMENT_DELETE = '''
+    CREATE TRIGGER %(table)s_delete INSTEAD OF DELETE ON %(table)s BEGIN
+        DELETE FROM %(compact)s WHERE id = OLD.id;
+    END;
+'''
+
+# New values are only stored by id if they are interned already.
+TAG_VIEW = '''
+    CREATE VIEW %(table)s AS
+    SELECT t.id, k.key, COALESCE(v.value, t.value) AS value, y.type
+    FROM %(compact)s t JOIN tag_keys k ON k.id = t.key_id
+    JOIN tag_types y ON y.id = t.type_id
+    LEFT JOIN tag_values v ON v.id = t.value_id;
+
+    CREATE TRIGGER %(table)s_insert INSTEAD OF INSERT ON %(table)s BEGIN
+        INSERT OR IGNORE INTO tag_keys(key) VALUES (NEW.key);
+        INSERT OR IGNORE INTO tag_types(type) VALUES (NEW.type);
+        INSERT INTO %(compact)s VALUES (NEW.id,
+            (SELECT id FROM tag_keys WHERE key = NEW.key),
+            (SELECT id FROM tag_values WHERE value = NEW.value),
+            CASE WHEN EXISTS (SELECT 1 FROM tag_values WHERE value = NEW.value)
+                 THEN NULL ELSE NEW.value END,
+            (SELECT id FROM tag_types WHERE type = NEW.type));
+    END;
+
+    CREATE TRIGGER %(table)s_delete INSTEAD OF DELETE ON %(table)s BEGIN
+        DELETE FROM %(compact)s WHERE id = OLD.id
+        AND key_id = (SELECT id FROM tag_keys WHERE key = OLD.key)
+        AND type_id = (SELECT id FROM tag_types WHERE type = OLD.type)
+        AND (value = OLD.value OR value_id = (SELECT id FROM tag_values WHERE value = OLD.value));
+    END;
+'''
+
+# Used instead of OSM_to_SQL.TABLE_INDEXES, since a view can't be indexed.
+COMPACT_TABLE_INDEXES = [
+    'CREATE UNIQUE INDEX IF NOT EXISTS compact_nodes_id ON compact_nodes(id)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS compact_ways_id ON compact_ways(id)',
+    'CREATE INDEX IF NOT EXISTS compact_nodes_tags_id ON compact_nodes_tags(id)',
+    'CREATE INDEX IF NOT EXISTS compact_ways_tags_id ON compact_ways_tags(id)',
+]
+
+# Used instead of indexes.REPORT_INDEXES.
+COMPACT_REPORT_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS compact_nodes_tags_key_value ON compact_nodes_tags(key_id, value_id)',
+    'CREATE INDEX IF NOT EXISTS compact_ways_tags_key_value ON compact_ways_tags(key_id, value_id)',
+    'CREATE INDEX IF NOT EXISTS ways_nodes_node_id ON ways_nodes(node_id)',
+    'CREATE INDEX IF NOT EXISTS ways_nodes_id_position ON ways_nodes(id, position)',
+    'CREATE INDEX IF NOT EXISTS compact_nodes_uid ON compact_nodes(uid)',
+    'CREATE INDEX IF NOT EXISTS compact_ways_uid ON compact_ways(uid)',
+]
+
+
+def is_compact(con):
+    """True if the database uses the compact schema"""
+    return con.execute("SELECT 1 FROM sqlite_master WHERE name = 'nodes' AND type = 'view'").fetchone() is not None
+
+
+def drop_compact_schema(con):
+    """Drop the views, compact tables and lookup tables, if there are any"""
+    views = set(name for name, in con.execute("SELECT name FROM sqlite_master WHERE type = 'view'"))
+    for table, compact, _, _ in COMPACT_TABLES:
+        # Dropping a view drops its triggers too.
+        if table in views:
+            con.execute('DROP VIEW %s' % table)
+        con.execute('DROP TABLE IF EXISTS %s' % compact)
+    for table, _ in LOOKUP_TABLES:
+        con.execute('DROP TABLE IF EXISTS %s' % table)
+
+
+def create_compact_schema(con):
+    """Create the lookup tables, the compact tables and the views standing in for the
+    normal tables. The normal tables must have been dropped already."""
+    for table, column in LOOKUP_TABLES:
+        con.execute('CREATE TABLE %s(id INTEGER PRIMARY KEY, %s TEXT UNIQUE)' % (table, column))
+    for table, compact, _, create_sql in COMPACT_TABLES:
+        con.execute(create_sql)
+    script = ''
+    for table, compact, _, _ in COMPACT_TABLES:
+        names = {'table': table, 'compact': compact}
+        if table in ELEMENT_VIEWS:
+            script += ELEMENT_VIEWS[table] + ELEMENT_DELETE % names
+        else:
+            script += TAG_VIEW % names
+    con.executescript(script)
+    con.commit()
+
+
+def compact_insert_sql(table, fields):
+    """The INSERT statement for rows of table encoded by TagEncoder.encode. Tables that
+    aren't compacted, like ways_nodes, are inserted into as they are."""
+    if table in COMPACT_FIELDS:
+        table, fields = COMPACT_FIELDS[table]
+    return 'INSERT INTO %s(%s) VALUES(%s);' % (table, ', '.join(fields), ', '.join('?' * len(fields)))
+
+
+class TagEncoder(object):
+    """Turns rows of the normal tables into rows of the compact ones, see the module
+    docstring. The ids of strings seen for the first time are assigned here, and their
+    lookup rows are kept until flush writes them."""
+
+    def __init__(self, value_limit=VALUE_LIMIT):
+        self.value_limit = value_limit
+        self.ids = dict((table, {}) for table, _ in LOOKUP_TABLES)
+        self.new_rows = dict((table, []) for table, _ in LOOKUP_TABLES)
+        # How many values of each key are interned, up to value_limit.
+        self.key_values = {}
+
+    def intern(self, table, text):
+        ids = self.ids[table]
+        string_id = ids.get(text)
+        if string_id is None:
+            string_id = ids[text] = len(ids) + 1
+            self.new_rows[table].append((string_id, text))
+        return string_id
+
+    def value(self, key, value):
+        """Return (value_id, value) for the tag row, one of them None"""
+        value_id = self.ids['tag_values'].get(value)
+        if value_id is not None:
+            return value_id, None
+        count = self.key_values.get(key, 0)
+        if count >= self.value_limit:
+            return None, value
+        self.key_values[key] = count + 1
+        return self.intern('tag_values', value), None
+
+    def encode(self, table, rows):
+        """Return the rows of a normal table, in its field order, as compact table rows"""
+        intern = self.intern
+        if table == 'nodes':
+            return [(row[0], row[1], row[2], intern('users', row[3])) + tuple(row[4:]) for row in rows]
+        if table == 'ways':
+            return [(row[0], intern('users', row[1])) + tuple(row[2:]) for row in rows]
+        if table in ('nodes_tags', 'ways_tags'):
+            encoded = []
+            for element_id, key, value, tag_type in rows:
+                value_id, value = self.value(key, value)
+                encoded.append((element_id, intern('tag_keys', key), value_id, value,
+                                intern('tag_types', tag_type)))
+            return encoded
+        return rows
+
+    def flush(self, con):
+        """Write the lookup rows of the strings interned since the last flush"""
+        for table, rows in self.new_rows.items():
+            if rows:
+                con.executemany('INSERT INTO %s VALUES (?, ?)' % table, rows)
+                del rows[:]
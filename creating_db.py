@@ -1,113 +1,111 @@
 import sqlite3
 import csv
+import time
+from itertools import islice
+from operator import itemgetter
+
+from indexes import build_indexes, check_query_plans
+from OSM_to_CSV import NODES_PATH, NODE_TAGS_PATH, WAYS_PATH, WAY_NODES_PATH, WAY_TAGS_PATH
+from spatial import build_spatial_index
+from summary import build_summary_tables
+from query_cache import bump_version
+from OSM_to_SQL import TABLES, bulk_load_settings, create_tables, create_indexes, insert_sql
+from compact_schema import TagEncoder, compact_insert_sql
 
 db = 'osm_stchas.sqlite'
 
-# Connecting to the database
-con = sqlite3.connect(db)
-con.text_factory = str
-cursor = con.cursor()
-
-# Here we drop all the tables we will soon make if they exist already to save us from data integrity issues when rerunning this file.
-# Unfortunately, SQLite3 doesn't allow dropping of multiple tables in one line..
-cursor.execute('''
-    DROP TABLE IF EXISTS nodes
-''')
-con.commit()
-
-cursor.execute('''
-    DROP TABLE IF EXISTS nodes_tags
-''')
-con.commit()
-
-cursor.execute('''
-    DROP TABLE IF EXISTS ways
-''')
-con.commit()
-
-
-cursor.execute('''
-    DROP TABLE IF EXISTS ways_tags
-''')
-con.commit()
-
-cursor.execute('''
-    DROP TABLE IF EXISTS ways_nodes
-''')
-con.commit()
-
-# Now we go head and create the nodes_tags table.
-
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS nodes_tags(id INTEGER, key TEXT, value TEXT, type TEXT)
-''')
-con.commit()
-
-with open('nodes_tags.csv', 'rb') as f:
-    dr = csv.DictReader(f)
-    iterate_db = [(i[b'id'], i[b'key'], i[b'value'], i[b'type']) for i in dr]
-
-# Lets go ahead and insert the data into the nodes_tags tables from the 'nodes_tags.csv' file.
-cursor.executemany('INSERT INTO nodes_tags(id, key, value, type) VALUES(?, ?, ?, ?);', iterate_db)
-con.commit()
-
-# Now we need to create the ways tables.
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS ways(id VARCHAR PRIMARY KEY, user TEXT, uid INTEGER, \
-    version VARCHAR, changeset INTEGER, timestamp DATETIME)
-''')
-con.commit()
-
-with open('ways.csv', 'r') as f:
-    dr = csv.DictReader(f)
-    iterate_db = [(i[b'id'], i[b'user'], i[b'uid'], i[b'version'], \
-    i[b'changeset'], i[b'timestamp']) for i in dr]
-
-# Insert the data from 'ways.csv' into the newly created ways table.
-cursor.executemany('INSERT INTO ways(id, user, uid, version, changeset, timestamp) VALUES(?, ?, ?, ?, ?, ?);', iterate_db)
-con.commit()
-
-# Now on to creating the ways_nodes table
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS ways_nodes(id INTEGER, node_id INTEGER, position INTEGER)
-''')
-con.commit()
-
-with open('ways_nodes.csv', 'r') as f:
-    dr = csv.DictReader(f)
-    iterate_db = [(i[b'id'], i[b'node_id'], i[b'position']) for i in dr]
-
-# Insert the data found in the 'ways_nodes.csv' file into the newly created ways_nodes table.
-cursor.executemany('INSERT INTO ways_nodes(id, node_id, position) VALUES(?, ?, ?);', iterate_db)
-con.commit()
-
-# We create the ways_tags table next.
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS ways_tags(id INTEGER , key TEXT, value TEXT, type TEXT)
-''')
-con.commit()
-
-with open('ways_tags.csv', 'r') as f:
-    dr = csv.DictReader(f)
-    iterate_db = [(i[b'id'], i[b'key'], i[b'value'], i[b'type']) for i in dr]
-
-# Insert the data found in 'ways_tags.csv' into the new ways_tags table.
-cursor.executemany('INSERT INTO ways_tags(id, key, value, type) VALUES(?, ?, ?, ?);', iterate_db)
-con.commit()
-
-#Finally, we create the nodes table.
-cursor.execute('''
-            CREATE TABLE IF NOT EXISTS nodes(id VARCHAR PRIMARY KEY, lat REAL,
-            lon REAL, user TEXT, uid INTEGER, version TEXT, changeset INTEGER, timestamp DATE)
-        ''')
-con.commit()
-
-with open('nodes.csv', 'r') as f:
-    dr = csv.DictReader(f)
-    iterate_db = [(i[b'id'], i[b'lat'], i[b'lon'], i[b'user'], \
-            i[b'uid'], i[b'version'], i[b'changeset'], i[b'timestamp']) for i in dr]
-
-# Insert the data.
-cursor.executemany("INSERT INTO nodes(id, lat, lon, user, uid, version, changeset, timestamp) \
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?);", iterate_db)
-con.commit()
\ No newline at end of file
+# How many rows are read from a csv file and inserted at a time.
+# Only one batch per table is held in memory, so memory use stays the same for any size of file.
+BATCH_SIZE = 10000
+
+# The csv file each table is loaded from.
+TABLE_CSVS = {
+    'nodes': NODES_PATH,
+    'nodes_tags': NODE_TAGS_PATH,
+    'ways': WAYS_PATH,
+    'ways_nodes': WAY_NODES_PATH,
+    'ways_tags': WAY_TAGS_PATH,
+}
+
+
+# Reads the csv file a batch of rows at a time instead of building one list of every row.
+# Each row is a tuple of the values in the same order as fields, whatever the order of the csv header.
+def read_batches(path, fields, batch_size=BATCH_SIZE):
+    with open(path, 'rb') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        get_fields = itemgetter(*[header.index(field) for field in fields])
+        rows = (get_fields(row) for row in reader)
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            yield batch
+
+
+# Inserts every row of the csv file into the table inside one transaction,
+# and reports how many rows were loaded per second.
+# With an encoder (see compact_schema.py) the rows go into the compact schema's tables.
+def load_table(con, table, fields, path, batch_size=BATCH_SIZE, encoder=None):
+    start = time.time()
+    count = 0
+    statement = insert_sql(table, fields) if encoder is None else compact_insert_sql(table, fields)
+    for batch in read_batches(path, fields, batch_size):
+        if encoder is not None:
+            batch = encoder.encode(table, batch)
+            encoder.flush(con)
+        con.executemany(statement, batch)
+        count += len(batch)
+    con.commit()
+
+    elapsed = time.time() - start
+    print('%s: %d rows in %.2f seconds (%d rows/sec)' % (table, count, elapsed, count / max(elapsed, 1e-6)))
+    return count
+
+
+# With compact_schema set, the repeated strings are stored once, see compact_schema.py.
+def create_db(db=db, batch_size=BATCH_SIZE, compact_schema=False):
+    # Connecting to the database
+    con = sqlite3.connect(db)
+    con.text_factory = str
+    encoder = TagEncoder() if compact_schema else None
+
+    try:
+        with bulk_load_settings(con):
+            # Here we drop all the tables we will soon make if they exist already to save us from
+            # data integrity issues when rerunning this file, and then create them empty.
+            create_tables(con, compact_schema)
+
+            # Lets go ahead and insert the data into each table from its .csv file.
+            for table, fields, _ in TABLES:
+                load_table(con, table, fields, TABLE_CSVS[table], batch_size, encoder)
+
+            # The unique indexes on the node and way ids, and the indexes the report queries
+            # use, are only built once all the data is in.
+            start = time.time()
+            create_indexes(con)
+            build_indexes(con)
+            print('indexes: %.2f seconds' % (time.time() - start))
+
+            # The counts the report queries read, kept up to date by triggers from here on.
+            start = time.time()
+            build_summary_tables(con)
+            print('summary tables: %.2f seconds' % (time.time() - start))
+
+            # Fail loudly if a report query has gone back to scanning a whole table.
+            check_query_plans(con)
+
+            # Fill the R*Tree tables used by the bounding box queries in spatial.py.
+            start = time.time()
+            build_spatial_index(con)
+            print('spatial index: %.2f seconds' % (time.time() - start))
+
+            # The data has changed, so cached query results of the old data are not used again.
+            bump_version(con)
+            con.commit()
+    finally:
+        con.close()
+
+
+if __name__ == '__main__':
+    create_db(db, BATCH_SIZE)
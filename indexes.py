@@ -0,0 +1,74 @@
+"""Secondary indexes for the report queries in queries.py, and checks that they are used.
+
+The loaders only build the unique indexes on the node and way ids, so without these
+every report query is a full scan of its table. build_indexes creates the indexes and
+runs ANALYZE, then check_query_plans runs EXPLAIN QUERY PLAN on every query in
+queries.REPORT_QUERIES and raises QueryPlanError if any of them scans a whole table
+instead of using an index.
+"""
+
+import re
+import sqlite3
+
+from queries import REPORT_QUERIES
+from compact_schema import is_compact, COMPACT_REPORT_INDEXES
+
+DB_PATH = 'osm_stchas.sqlite'
+
+REPORT_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS nodes_tags_key_value ON nodes_tags(key, value)',
+    'CREATE INDEX IF NOT EXISTS ways_tags_key_value ON ways_tags(key, value)',
+    'CREATE INDEX IF NOT EXISTS ways_nodes_node_id ON ways_nodes(node_id)',
+    'CREATE INDEX IF NOT EXISTS ways_nodes_id_position ON ways_nodes(id, position)',
+    'CREATE INDEX IF NOT EXISTS nodes_uid ON nodes(uid)',
+    'CREATE INDEX IF NOT EXISTS ways_uid ON ways(uid)',
+]
+
+# Matches a plan step that reads a table row by row. Older SQLite versions say "SCAN TABLE nodes".
+TABLE_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)')
+
+
+class QueryPlanError(Exception):
+    """Raised when a report query would scan a whole table"""
+
+
+def build_indexes(con):
+    """Create the report indexes and update the statistics the query planner uses"""
+    for create_sql in COMPACT_REPORT_INDEXES if is_compact(con) else REPORT_INDEXES:
+        con.execute(create_sql)
+    con.execute('ANALYZE')
+    con.commit()
+
+
+def full_scans(con, query, params=()):
+    """Return the steps of the query plan that scan a table without an index"""
+    tables = set(name for name, in con.execute("SELECT name FROM sqlite_master WHERE type = 'table'"))
+    scans = []
+    for row in con.execute('EXPLAIN QUERY PLAN ' + query, params):
+        detail = row[-1]
+        m = TABLE_SCAN.match(detail)
+        # Scans of subqueries, like the "e" in number_of_unique_users, are fine.
+        if m and m.group(1) in tables and 'INDEX' not in detail:
+            scans.append(detail)
+    return scans
+
+
+def check_query_plans(con, queries=None):
+    """Raise QueryPlanError if any of the queries (a dict of name to sql, by default every
+    report query) does a full table scan"""
+    if queries is None:
+        queries = REPORT_QUERIES
+
+    problems = []
+    for name, query in sorted(queries.items()):
+        for detail in full_scans(con, query):
+            problems.append('%s: %s' % (name, detail))
+    if problems:
+        raise QueryPlanError('Report queries are scanning whole tables:\n' + '\n'.join(problems))
+
+
+if __name__ == '__main__':
+    con = sqlite3.connect(DB_PATH)
+    build_indexes(con)
+    check_query_plans(con)
+    print('All %d report queries use indexes.' % len(REPORT_QUERIES))
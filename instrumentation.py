@@ -0,0 +1,238 @@
+"""Progress and per-stage timing of the conversion in OSM_to_CSV.py.
+
+Metrics keeps the time spent in each stage of process_map, counts the elements, tags
+and the rows written to each csv file, and works out the throughput and the time left
+from how far into the input file the parser is. Every so often it hands a snapshot of
+the numbers to a sink, which decides what to do with it:
+
+- QuietSink does nothing, for when the numbers are only read at the end.
+- ProgressSink keeps one progress line up to date on stderr.
+- JsonLinesSink writes every snapshot as a line of JSON, for other tools to read.
+
+The stages are parse (waiting for iterparse to hand over the next element), shape,
+clean (the street, postcode and city update functions, timed by their caches in
+Audit.py), validate and write. Cleaning happens while shaping, so the shape time
+doesn't include it. Timing a stage is one clock read, and the sink is only checked
+every CHECK_EVERY elements, so it costs little enough to leave on.
+"""
+
+from __future__ import print_function
+
+import json
+import sys
+from timeit import default_timer as clock
+
+from Audit import street_cache, postcode_cache, city_cache
+
+STAGES = ('parse', 'shape', 'clean', 'validate', 'write')
+
+# The csv file each kind of row goes to, named like the SQL tables.
+ROW_FILES = ('nodes', 'nodes_tags', 'ways', 'ways_nodes', 'ways_tags')
+
+# Seconds between snapshots handed to the sink.
+REPORT_INTERVAL = 2.0
+
+# Elements between checks of whether a snapshot is due.
+CHECK_EVERY = 1000
+
+CLEANING_CACHES = (street_cache, postcode_cache, city_cache)
+
+
+def cleaning_seconds():
+    return sum(cache.seconds for cache in CLEANING_CACHES)
+
+
+class QuietSink(object):
+    """Throws the snapshots away"""
+
+    def report(self, snapshot):
+        pass
+
+    def finish(self, snapshot):
+        pass
+
+
+class ProgressSink(object):
+    """Keeps a human readable progress line up to date"""
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stderr
+
+    def format(self, snapshot):
+        line = '%(elements)d elements, %(elements_per_sec).0f/s' % snapshot
+        if snapshot['total_bytes']:
+            line += ', %.1f%% of %.1fMB' % (100.0 * snapshot['bytes'] / snapshot['total_bytes'],
+                                          snapshot['total_bytes'] / 1048576.0)
+        line += ', %.2fMB/s' % (snapshot['bytes_per_sec'] / 1048576.0)
+        if snapshot['eta'] is not None:
+            line += ', ETA %ds' % snapshot['eta']
+        return line
+
+    def report(self, snapshot):
+        self.stream.write('\r' + self.format(snapshot).ljust(79))
+        self.stream.flush()
+
+    def finish(self, snapshot):
+        stages = ', '.join('%s %.2fs' % (stage, snapshot['seconds'][stage]) for stage in STAGES)
+        self.stream.write('\r%s in %.2fs (%s)\n' % (self.format(snapshot), snapshot['elapsed'], stages))
+        self.stream.flush()
+
+
+class JsonLinesSink(object):
+    """Writes each snapshot as one line of JSON to a file or a path"""
+
+    def __init__(self, output=None):
+        self.close_output = not hasattr(output, 'write') and output is not None
+        self.output = open(output, 'a') if self.close_output else (output or sys.stdout)
+
+    def write(self, event, snapshot):
+        record = dict(snapshot, event=event)
+        self.output.write(json.dumps(record, sort_keys=True) + '\n')
+        self.output.flush()
+
+    def report(self, snapshot):
+        self.write('progress', snapshot)
+
+    def finish(self, snapshot):
+        self.write('finish', snapshot)
+        if self.close_output:
+            self.output.close()
+
+
+SINKS = {
+    'quiet': QuietSink,
+    'progress': ProgressSink,
+    'json': JsonLinesSink,
+}
+
+
+class Metrics(object):
+    """Stage times, counters and throughput of one conversion, see the module docstring.
+
+    source is the open input file, used to see how far the parser has read, and
+    total_bytes its size. The loops in OSM_to_CSV.py call lap at the end of each stage
+    and add for every element."""
+
+    def __init__(self, sink=None, source=None, total_bytes=None, interval=REPORT_INTERVAL):
+        self.sink = sink if sink is not None else QuietSink()
+        self.source = source
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.seconds = dict.fromkeys(STAGES, 0.0)
+        self.elements = {'node': 0, 'way': 0}
+        self.tags = 0
+        self.rows = dict.fromkeys(ROW_FILES, 0)
+        self.offset = 0
+        self.count = 0
+        self.start()
+
+    def start(self):
+        self.started = self.last = self.last_report = clock()
+        self.clean_start = cleaning_seconds()
+        self.last_bytes = self.last_count = 0
+        self.rolling = (0.0, 0.0)
+
+    def lap(self, stage):
+        """Add the time since the last lap to stage"""
+        now = clock()
+        self.seconds[stage] += now - self.last
+        self.last = now
+
+    def add(self, tag, tag_count, way_node_count=0):
+        """Count an element and the rows written for it"""
+        self.elements[tag] += 1
+        self.tags += tag_count
+        rows = self.rows
+        if tag == 'node':
+            rows['nodes'] += 1
+            rows['nodes_tags'] += tag_count
+        else:
+            rows['ways'] += 1
+            rows['ways_tags'] += tag_count
+            rows['ways_nodes'] += way_node_count
+        self.count += 1
+        if self.count % CHECK_EVERY == 0 and clock() - self.last_report >= self.interval:
+            self.report()
+
+    def position(self):
+        """How many bytes of the input have been read"""
+        if self.source is not None:
+            try:
+                return self.source.tell()
+            except (IOError, OSError, ValueError):
+                pass
+        return self.offset
+
+    def snapshot(self):
+        now = clock()
+        elapsed = now - self.started
+        position = self.position()
+
+        # The rates are over the time since the last snapshot, so they follow the current speed.
+        interval = now - self.last_report
+        if interval > 0 and self.count > self.last_count:
+            self.rolling = ((self.count - self.last_count) / interval, (position - self.last_bytes) / interval)
+        elif elapsed > 0 and self.rolling == (0.0, 0.0):
+            self.rolling = (self.count / elapsed, position / elapsed)
+        elements_per_sec, bytes_per_sec = self.rolling
+
+        eta = None
+        if self.total_bytes and bytes_per_sec > 0:
+            eta = max(self.total_bytes - position, 0) / bytes_per_sec
+
+        seconds = dict(self.seconds)
+        seconds['clean'] += cleaning_seconds() - self.clean_start
+        seconds['shape'] = max(seconds['shape'] - seconds['clean'], 0.0)
+        return {
+            'elapsed': elapsed,
+            'elements': self.count,
+            'nodes': self.elements['node'],
+            'ways': self.elements['way'],
+            'tags': self.tags,
+            'rows': dict(self.rows),
+            'seconds': seconds,
+            'bytes': position,
+            'total_bytes': self.total_bytes,
+            'elements_per_sec': elements_per_sec,
+            'bytes_per_sec': bytes_per_sec,
+            'eta': eta,
+        }
+
+    def report(self):
+        snapshot = self.snapshot()
+        self.last_report = clock()
+        self.last_bytes = snapshot['bytes']
+        self.last_count = self.count
+        self.sink.report(snapshot)
+
+    def finish(self):
+        """Hand the final numbers to the sink and return them"""
+        # The final rates are over the whole run.
+        self.last_report = self.started
+        self.last_bytes = self.last_count = 0
+        snapshot = self.snapshot()
+        self.sink.finish(snapshot)
+        return snapshot
+
+    def totals(self):
+        """The counters and stage times, to be merged into another Metrics with merge"""
+        seconds = dict(self.seconds)
+        seconds['clean'] += cleaning_seconds() - self.clean_start
+        return {'seconds': seconds, 'elements': dict(self.elements),
+                'tags': self.tags, 'rows': dict(self.rows)}
+
+    def merge(self, totals, position=None):
+        """Add the totals of a chunk converted elsewhere, e.g. by a worker process, and
+        report if a snapshot is due. position is how far into the input the chunk ended."""
+        for stage, seconds in totals['seconds'].items():
+            self.seconds[stage] += seconds
+        for tag, count in totals['elements'].items():
+            self.elements[tag] += count
+            self.count += count
+        for name, count in totals['rows'].items():
+            self.rows[name] += count
+        self.tags += totals['tags']
+        if position is not None:
+            self.offset = position
+        if clock() - self.last_report >= self.interval:
+            self.report()
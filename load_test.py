@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Load test of query_server.py: many clients sending requests to the service at once.
+
+Each client is a thread with one kept-alive HTTP connection. It goes through the paths
+in turn, starting at a different one from the other clients, and records how long every
+request took until the total number of requests has been sent. The latency percentiles
+and requests/sec are printed per path and over all of them, and can be written to a JSON
+file like benchmark.py's.
+
+Without --url a service is started on a free port for the test, on the database given
+with --db.
+
+Usage: python load_test.py [--url http://127.0.0.1:8642] [--clients 16] [--requests 5000]
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import sys
+import threading
+import time
+from timeit import default_timer as clock
+
+try:
+    from http.client import HTTPConnection
+    from urllib.parse import urlparse
+except ImportError:
+    from httplib import HTTPConnection
+    from urlparse import urlparse
+
+from queries import REPORT_QUERIES
+import query_server
+
+DEFAULT_CLIENTS = 16
+DEFAULT_REQUESTS = 5000
+
+# The reports, and lookups around Saint Charles' Main Street.
+DEFAULT_PATHS = ['/reports/%s' % name for name in sorted(REPORT_QUERIES)] + [
+    '/tags?key=amenity',
+    '/tags?key=amenity&bbox=38.77,-90.50,38.80,-90.47',
+    '/nodes?bbox=38.78,-90.49,38.79,-90.48',
+    '/ways?bbox=38.78,-90.49,38.79,-90.48',
+]
+
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(sorted_values, percent):
+    """The value below which percent of sorted_values fall, nearest rank"""
+    if not sorted_values:
+        return None
+    index = int(round(percent / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def run_client(host, port, paths, count, offset, latencies, errors):
+    con = HTTPConnection(host, port)
+    try:
+        for i in range(count):
+            path = paths[(offset + i) % len(paths)]
+            start = clock()
+            try:
+                con.request('GET', path)
+                response = con.getresponse()
+                response.read()
+            except Exception as e:
+                errors.append('%s: %s' % (path, e))
+                con.close()
+                con = HTTPConnection(host, port)
+                continue
+            latencies.append((path, clock() - start))
+            if response.status != 200:
+                errors.append('%s: HTTP %d' % (path, response.status))
+    finally:
+        con.close()
+
+
+def summarize(latencies, seconds):
+    latencies = sorted(latencies)
+    summary = {'requests': len(latencies),
+               'requests_per_sec': len(latencies) / seconds if seconds > 0 else None,
+               'max_ms': latencies[-1] * 1000 if latencies else None}
+    for percent in PERCENTILES:
+        value = percentile(latencies, percent)
+        summary['p%d_ms' % percent] = value * 1000 if value is not None else None
+    return summary
+
+
+def load_test(url, paths=DEFAULT_PATHS, clients=DEFAULT_CLIENTS, requests=DEFAULT_REQUESTS):
+    """Send requests to the service at url from the given number of clients at once,
+    and return the latency summary over all requests and per path"""
+    address = urlparse(url)
+    latencies = []
+    errors = []
+    threads = []
+    for client in range(clients):
+        # Share the requests out, the first clients taking one more if they don't divide.
+        count = requests // clients + (1 if client < requests % clients else 0)
+        threads.append(threading.Thread(target=run_client, args=(
+            address.hostname, address.port, paths, count, client, latencies, errors)))
+
+    start = clock()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = clock() - start
+
+    by_path = dict((path, []) for path in paths)
+    for path, latency in latencies:
+        by_path[path].append(latency)
+    return {
+        'clients': clients,
+        'seconds': seconds,
+        'errors': len(errors),
+        'first_errors': errors[:10],
+        'total': summarize([latency for _, latency in latencies], seconds),
+        'paths': dict((path, summarize(values, seconds)) for path, values in by_path.items()),
+    }
+
+
+def print_results(results):
+    print('%d clients, %d requests in %.2f seconds, %d errors' % (
+        results['clients'], results['total']['requests'], results['seconds'], results['errors']))
+    for error in results['first_errors']:
+        print('  ' + error)
+    print('%-60s %8s %8s %8s %8s %8s' % ('path', 'req/s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+    rows = sorted(results['paths'].items()) + [('all', results['total'])]
+    for path, summary in rows:
+        if not summary['requests']:
+            continue
+        print('%-60s %8.0f %8.2f %8.2f %8.2f %8.2f' % (
+            path[:60], summary['requests_per_sec'], summary['p50_ms'], summary['p90_ms'],
+            summary['p99_ms'], summary['max_ms']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test the query service.')
+    parser.add_argument('--url', help='service to test (default: start one on --db)')
+    parser.add_argument('--db', default=query_server.DB_PATH, help='database of the service started for the test')
+    parser.add_argument('--pool-size', type=int, default=query_server.POOL_SIZE)
+    parser.add_argument('--clients', type=int, default=DEFAULT_CLIENTS)
+    parser.add_argument('--requests', type=int, default=DEFAULT_REQUESTS)
+    parser.add_argument('--paths', help='comma separated paths to request (default: every report and lookup)')
+    parser.add_argument('--output', help='JSON file for the results')
+    args = parser.parse_args(argv)
+
+    paths = args.paths.split(',') if args.paths else DEFAULT_PATHS
+    server = pool = None
+    url = args.url
+    if url is None:
+        pool = query_server.ConnectionPool(args.db, args.pool_size)
+        server = query_server.QueryServer((query_server.HOST, 0), query_server.QueryService(pool))
+        threading.Thread(target=server.serve_forever).start()
+        url = 'http://%s:%d' % server.server_address
+
+    try:
+        results = load_test(url, paths, args.clients, args.requests)
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+            pool.close()
+
+    results['url'] = url
+    results['timestamp'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('Results written to %s' % args.output)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,181 @@
+"""Compact node id -> (lat, lon) index, filled while the OSM file is streamed.
+
+shape_element only writes the nd refs of a way, so anything that needs the coordinates of
+a way has to join ways_nodes to nodes later in SQLite. NodeLocationIndex keeps the location
+of every node seen by get_element (pass it as node_locations) so the ways that come after
+the nodes can be resolved to coordinates in the same pass.
+
+The index is a sorted int64 id array with two parallel int32 arrays of the coordinates in
+1e-7 degrees, the precision OSM stores them in, so it takes 16 bytes a node instead of a
+dict entry and two float objects. Lookups are a binary search with searchsorted. Once more
+than memory_limit nodes have been added, the arrays are spilled to files in spill_dir (or
+a temporary directory) and memory-mapped, so big extracts don't have to fit in memory.
+
+Nodes are added in batches, and a batch is sorted into a segment the first time a lookup
+needs it. OSM files list every node before the first way, so there is normally only one
+segment. Nodes added after a lookup go into a new segment, which is searched as well.
+"""
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+# Coordinates are stored as integers in units of 1e-7 degrees.
+COORDINATE_SCALE = 10000000
+
+# How many nodes are collected in Python lists before they are turned into arrays.
+BUFFER_ROWS = 65536
+
+# How many nodes a segment holds in memory before it is spilled to memory-mapped files.
+MEMORY_LIMIT = 50000000
+
+COLUMNS = (('ids', np.int64), ('lats', np.int32), ('lons', np.int32))
+
+
+def to_fixed(values):
+    """Convert degrees to int32 units of 1e-7 degrees"""
+    return np.round(np.asarray(values, dtype=np.float64) * COORDINATE_SCALE).astype(np.int32)
+
+
+class NodeLocationIndex(object):
+    """Array backed index of node locations, see the module docstring"""
+
+    def __init__(self, spill_dir=None, memory_limit=MEMORY_LIMIT):
+        self.spill_dir = spill_dir
+        self.memory_limit = memory_limit
+        self.temp_dir = None
+        self.segments = []
+        self.buffers = ([], [], [])
+        self.chunks = []
+        self.spill_files = None
+        self.pending = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, node_id, lat, lon):
+        """Add the location of a node, with lat and lon in degrees (strings are fine)"""
+        ids, lats, lons = self.buffers
+        ids.append(int(node_id))
+        lats.append(float(lat))
+        lons.append(float(lon))
+        self.count += 1
+        if len(ids) >= BUFFER_ROWS:
+            self.flush()
+
+    def add_element(self, element):
+        """Add a node element from iterparse. Nodes without a location are skipped."""
+        attrib = element.attrib
+        lat = attrib.get('lat')
+        lon = attrib.get('lon')
+        if lat is not None and lon is not None:
+            self.add(attrib['id'], lat, lon)
+
+    def flush(self):
+        """Turn the buffered nodes into arrays, spilling them to disk past memory_limit"""
+        ids, lats, lons = self.buffers
+        if not ids:
+            return
+        chunk = (np.array(ids, dtype=np.int64), to_fixed(lats), to_fixed(lons))
+        for buf in self.buffers:
+            del buf[:]
+        self.pending += len(chunk[0])
+
+        if self.spill_files is None and self.pending > self.memory_limit:
+            self.start_spill()
+        if self.spill_files is not None:
+            for f, column in zip(self.spill_files, chunk):
+                column.tofile(f)
+        else:
+            self.chunks.append(chunk)
+
+    def start_spill(self):
+        directory = self.spill_dir
+        if directory is None:
+            directory = self.temp_dir = self.temp_dir or tempfile.mkdtemp(prefix='osm_node_locations_')
+        elif not os.path.isdir(directory):
+            os.makedirs(directory)
+        number = len(self.segments)
+        self.spill_files = [open(self.spill_path(number, name), 'wb') for name, _ in COLUMNS]
+        # Everything held in memory so far goes to the files first, in the order it was added.
+        for chunk in self.chunks:
+            for f, column in zip(self.spill_files, chunk):
+                column.tofile(f)
+        self.chunks = []
+
+    def spill_path(self, number, name):
+        return os.path.join(self.spill_dir or self.temp_dir, 'segment%03d_%s.bin' % (number, name))
+
+    def seal(self):
+        """Sort the nodes added since the last lookup into a new segment"""
+        self.flush()
+        if self.pending == 0:
+            return
+        if self.spill_files is not None:
+            for f in self.spill_files:
+                f.close()
+            number = len(self.segments)
+            columns = [np.memmap(self.spill_path(number, name), dtype=dtype, mode='r+',
+                                 shape=(self.pending,))
+                       for name, dtype in COLUMNS]
+        else:
+            columns = [np.concatenate(column) for column in zip(*self.chunks)]
+
+        ids = columns[0]
+        if len(ids) > 1 and (ids[1:] < ids[:-1]).any():
+            # Sort in place so spilled segments stay memory-mapped.
+            order = np.argsort(ids, kind='mergesort')
+            for column in columns:
+                column[:] = column[order]
+        if self.spill_files is not None:
+            for column in columns:
+                column.flush()
+
+        self.segments.append(tuple(columns))
+        self.chunks = []
+        self.spill_files = None
+        self.pending = 0
+
+    def lookup(self, node_ids):
+        """Return (lats, lons) float64 arrays in degrees for node_ids, NaN where the node isn't known"""
+        self.seal()
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        lats = np.full(node_ids.shape, np.nan)
+        lons = np.full(node_ids.shape, np.nan)
+        for ids, fixed_lats, fixed_lons in self.segments:
+            index = np.minimum(np.searchsorted(ids, node_ids), len(ids) - 1)
+            found = ids[index] == node_ids
+            lats[found] = fixed_lats[index[found]] / float(COORDINATE_SCALE)
+            lons[found] = fixed_lons[index[found]] / float(COORDINATE_SCALE)
+        return lats, lons
+
+    def location(self, node_id):
+        """Return (lat, lon) of one node, or None if it isn't known"""
+        lats, lons = self.lookup([node_id])
+        if np.isnan(lats[0]):
+            return None
+        return float(lats[0]), float(lons[0])
+
+    def way_coordinates(self, element):
+        """Return a list of (lat, lon) for the nd refs of a way element, in order.
+        Nodes that aren't known are left out."""
+        refs = [nd.attrib['ref'] for nd in element.iter('nd')]
+        if not refs:
+            return []
+        lats, lons = self.lookup(refs)
+        known = ~np.isnan(lats)
+        return list(zip(lats[known].tolist(), lons[known].tolist()))
+
+    def close(self):
+        """Drop the arrays and delete any files spilled to a temporary directory"""
+        for f in self.spill_files or ():
+            f.close()
+        self.segments = []
+        self.chunks = []
+        self.spill_files = None
+        if self.temp_dir is not None:
+            shutil.rmtree(self.temp_dir, ignore_errors=True)
+            self.temp_dir = None
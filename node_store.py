@@ -0,0 +1,176 @@
+"""Columnar node store that can be memory-mapped with NumPy.
+
+Pulling the nodes table out of SQLite converts every row to Python objects one at a time.
+The conversion in OSM_to_CSV.py can instead also write the nodes to a directory of .npy
+files, one per column (id, lat, lon, uid, changeset and version), plus a small nodes.json
+header with the row count and whether the ids are sorted. The files are normal .npy files,
+so np.load(path, mmap_mode='r') maps them without copying, and NodeStore does that for
+every column and adds id lookups and bounding box filters on the mapped arrays.
+
+The .npy header is written with a fixed size when the file is opened and filled in with the
+row count when the writer is closed, so the columns can be streamed straight to disk.
+"""
+
+import json
+import os
+import struct
+
+import numpy as np
+
+HEADER_FILE = 'nodes.json'
+FORMAT_VERSION = 1
+
+# The stored columns, their dtype and their position in OSM_to_CSV.NODE_FIELDS.
+COLUMNS = [
+    ('id', '<i8', 0, int),
+    ('lat', '<f8', 1, float),
+    ('lon', '<f8', 2, float),
+    ('uid', '<i8', 4, int),
+    ('version', '<i4', 5, int),
+    ('changeset', '<i8', 6, int),
+]
+
+# Size of the .npy preamble and header, a multiple of 64 bytes as the format asks for.
+NPY_HEADER_SIZE = 128
+NPY_MAGIC = b'\x93NUMPY\x01\x00'
+
+BUFFER_ROWS = 65536
+
+
+def npy_header(dtype, count):
+    """Return the fixed size .npy version 1.0 header for a 1-d array of count items"""
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (dtype, count)
+    header = header.ljust(NPY_HEADER_SIZE - len(NPY_MAGIC) - 2 - 1) + '\n'
+    return NPY_MAGIC + struct.pack('<H', len(header)) + header.encode('latin1')
+
+
+def column_path(directory, name):
+    return os.path.join(directory, name + '.npy')
+
+
+class NodeStoreWriter(object):
+    """Streams node rows (tuples in NODE_FIELDS order) into a columnar node store"""
+
+    def __init__(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.files = []
+        for name, dtype, _, _ in COLUMNS:
+            f = open(column_path(directory, name), 'wb')
+            f.write(npy_header(dtype, 0))
+            self.files.append(f)
+        self.buffers = [[] for _ in COLUMNS]
+        self.count = 0
+        self.last_id = None
+        self.sorted = True
+
+    def add(self, row):
+        for buf, (_, _, position, convert) in zip(self.buffers, COLUMNS):
+            buf.append(convert(row[position]))
+        node_id = self.buffers[0][-1]
+        if self.last_id is not None and node_id < self.last_id:
+            self.sorted = False
+        self.last_id = node_id
+        self.count += 1
+        if len(self.buffers[0]) >= BUFFER_ROWS:
+            self.flush()
+
+    def flush(self):
+        for f, buf, (_, dtype, _, _) in zip(self.files, self.buffers, COLUMNS):
+            np.array(buf, dtype=dtype).tofile(f)
+            del buf[:]
+
+    def append_store(self, directory):
+        """Append every node of another node store, e.g. one written for a chunk of the file"""
+        self.flush()
+        other = NodeStore(directory)
+        if other.count == 0:
+            return
+        first_id = int(other['id'][0])
+        if not other.sorted or (self.last_id is not None and first_id < self.last_id):
+            self.sorted = False
+        for f, (name, dtype, _, _) in zip(self.files, COLUMNS):
+            other[name].tofile(f)
+        self.last_id = int(other['id'][-1])
+        self.count += other.count
+
+    def close(self):
+        self.flush()
+        for f, (_, dtype, _, _) in zip(self.files, COLUMNS):
+            f.seek(0)
+            f.write(npy_header(dtype, self.count))
+            f.close()
+        header = {
+            'version': FORMAT_VERSION,
+            'count': self.count,
+            'sorted': self.sorted,
+            'columns': dict((name, dtype) for name, dtype, _, _ in COLUMNS),
+        }
+        with open(os.path.join(self.directory, HEADER_FILE), 'w') as f:
+            json.dump(header, f, indent=2, sort_keys=True)
+
+
+class NodeStore(object):
+    """Read only view of a node store, with each column memory-mapped"""
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, HEADER_FILE)) as f:
+            header = json.load(f)
+        if header['version'] != FORMAT_VERSION:
+            raise ValueError('Unsupported node store version: %r' % header['version'])
+        self.directory = directory
+        self.count = header['count']
+        self.sorted = header['sorted']
+        # An empty file can't be memory-mapped, so an empty store is just loaded.
+        mmap_mode = 'r' if self.count else None
+        self.columns = dict((name, np.load(column_path(directory, name), mmap_mode=mmap_mode))
+                            for name in header['columns'])
+        self._order = None
+        self._sorted_ids = None
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __len__(self):
+        return self.count
+
+    def positions(self, ids):
+        """Return the row position of each id, or -1 for ids that aren't in the store"""
+        ids = np.asarray(ids, dtype=np.int64)
+        if self.count == 0:
+            return np.full(ids.shape, -1, dtype=np.int64)
+        if self.sorted:
+            order = None
+            sorted_ids = self.columns['id']
+        else:
+            # Sort the ids once, then search the sorted copy.
+            if self._order is None:
+                self._order = np.argsort(self.columns['id'], kind='mergesort')
+                self._sorted_ids = self.columns['id'][self._order]
+            order = self._order
+            sorted_ids = self._sorted_ids
+        index = np.minimum(np.searchsorted(sorted_ids, ids), self.count - 1)
+        found = sorted_ids[index] == ids
+        positions = index if order is None else order[index]
+        return np.where(found, positions, -1)
+
+    def lookup(self, ids, columns=('lat', 'lon')):
+        """Return a dict of column arrays for the given node ids. Missing ids raise KeyError."""
+        positions = self.positions(ids)
+        if (positions < 0).any():
+            missing = np.asarray(ids)[positions < 0]
+            raise KeyError('Node ids not in the store: %s' % missing[:10].tolist())
+        return dict((name, self.columns[name][positions]) for name in columns)
+
+    def bbox(self, bbox):
+        """Return the row positions of the nodes inside (min_lat, min_lon, max_lat, max_lon)"""
+        min_lat, min_lon, max_lat, max_lon = bbox
+        lat = self.columns['lat']
+        lon = self.columns['lon']
+        return np.flatnonzero((lat >= min_lat) & (lat <= max_lat) & (lon >= min_lon) & (lon <= max_lon))
+
+    def nodes_in_bbox(self, bbox, columns=('id', 'lat', 'lon')):
+        """Return a dict of column arrays for the nodes inside the bounding box"""
+        positions = self.bbox(bbox)
+        return dict((name, self.columns[name][positions]) for name in columns)
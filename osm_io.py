@@ -0,0 +1,410 @@
+"""Opens OSM files for reading, decompressing .gz and .bz2 files as they are read.
+
+Extracts are usually downloaded as .osm.bz2 or .osm.gz. open_osm looks at the first bytes
+of the file and returns a file-like object that the parsers can read the XML from, so the
+file never has to be decompressed to disk first. Files made of several compressed streams
+one after the other (multistream bz2 from pbzip2/lbzip2, or gzip files with several
+members) are read to the end, not just to the end of the first stream.
+
+For a multistream bz2 file the streams are decompressed in parallel by a pool of worker
+processes. The file is scanned for the start of each stream, the streams are grouped into
+jobs of about JOB_SIZE compressed bytes, and the decompressed jobs are handed to the parser
+in file order. Only a few jobs are in flight at once, so memory use stays flat.
+
+tell() on the returned object gives how far into the file on disk it has read, not into
+the decompressed XML, so it can be used with the file size for progress (see
+instrumentation.py).
+
+RangeReader streams just the elements between two byte offsets of an uncompressed file,
+for the chunks of the parallel conversion and for a conversion carrying on from a
+checkpoint (see checkpoint.py).
+
+.osm.pbf files aren't XML at all. For them open_osm returns a pbf_reader.PBFReader, whose
+elements method yields OSMElement records instead of the parsers reading XML from it.
+OSMElement looks enough like an ElementTree element (tag, attrib and iter('tag') /
+iter('nd')) that shape_element and the auditors take it unchanged.
+
+expat_elements is a faster alternative to ElementTree's iterparse for the XML. It builds an
+OSMElement straight from the expat start events instead of a tree of Elements, and can drop
+unwanted element types and tag keys before anything is allocated for them. get_element and
+the auditors use it when their backend is 'expat'.
+"""
+
+import bz2
+import multiprocessing
+import zlib
+from collections import deque
+from itertools import islice
+from xml.parsers import expat
+
+GZIP_MAGIC = b'\x1f\x8b'
+BZ2_MAGIC = b'BZh'
+
+# A PBF file starts with the length of the first BlobHeader, then the header's type field,
+# which is always "OSMHeader" for the first blob.
+PBF_MAGIC = b'\x0a\x09OSMHeader'
+
+# A bz2 stream starts with "BZh", the block size digit and then the magic number of the first
+# block, so the start of every stream in a multistream file can be found by searching for this.
+BZ2_STREAM_START = [BZ2_MAGIC + str(level).encode('ascii') + b'1AY&SY' for level in range(1, 10)]
+
+# Bytes read from the file at a time.
+READ_SIZE = 1024 * 1024
+
+# Compressed bytes decompressed by one worker job.
+JOB_SIZE = 8 * 1024 * 1024
+
+# A job without any stream start in it bigger than this is decompressed in this process
+# a piece at a time instead, so a single stream bz2 file isn't held in memory.
+MAX_JOB_SIZE = 8 * JOB_SIZE
+
+# Jobs handed to the pool ahead of the parser, per worker.
+JOBS_AHEAD = 2
+
+# Processes used to decompress multistream bz2 files. One core is left for the parser.
+DECOMPRESS_WORKERS = max(1, multiprocessing.cpu_count() - 1)
+
+# The XML parsers get_element and the auditors can use, and the one they use by default.
+BACKENDS = ('etree', 'expat')
+DEFAULT_BACKEND = 'etree'
+
+# Bytes of XML handed to expat at a time.
+PARSE_SIZE = 64 * 1024
+
+# The elements that can be directly inside <osm>. Each one ends the element before it.
+TOP_LEVEL = frozenset(['node', 'way', 'relation', 'bounds', 'bound', 'changeset'])
+
+
+def file_format(path):
+    """Return 'gzip', 'bz2', 'pbf' or 'xml' from the first bytes of the file"""
+    with open(path, 'rb') as f:
+        head = f.read(4 + len(PBF_MAGIC))
+    if head[:2] == GZIP_MAGIC:
+        return 'gzip'
+    if head[:3] == BZ2_MAGIC:
+        return 'bz2'
+    if head[4:] == PBF_MAGIC:
+        return 'pbf'
+    return 'xml'
+
+
+def gzip_blocks(raw):
+    """Yield the decompressed data of every member of a gzip file, with the position in raw"""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    while True:
+        data = raw.read(READ_SIZE)
+        if not data:
+            break
+        while data:
+            yield decompressor.decompress(data), raw.tell()
+            data = decompressor.unused_data
+            if data:
+                # The member ended inside this read, the rest is the next member.
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    yield decompressor.flush(), raw.tell()
+
+
+def bz2_blocks(raw, end=None):
+    """Yield the decompressed data of every stream of a bz2 file, with the position in raw.
+    Stops at the byte offset end if it is given."""
+    decompressor = bz2.BZ2Decompressor()
+    while True:
+        size = READ_SIZE if end is None else min(READ_SIZE, end - raw.tell())
+        data = raw.read(size) if size > 0 else b''
+        if not data:
+            break
+        while data:
+            try:
+                yield decompressor.decompress(data), raw.tell()
+            except EOFError:
+                # The last stream ended right at the end of the previous read.
+                decompressor = bz2.BZ2Decompressor()
+                continue
+            data = decompressor.unused_data
+            if data:
+                decompressor = bz2.BZ2Decompressor()
+
+
+def find_bz2_streams(raw, size, limit=None):
+    """Yield the byte offset of the start of every stream in a bz2 file, only looking at
+    the first limit bytes if limit is given"""
+    overlap = len(BZ2_STREAM_START[0]) - 1
+    stop = size if limit is None else min(size, limit)
+    position = 0
+    while position < stop:
+        # Each read runs a little into the next one, so a stream start split between two
+        # reads is still found. Only the starts inside this read's own range are kept.
+        raw.seek(position)
+        data = raw.read(READ_SIZE + overlap)
+        index = data.find(BZ2_MAGIC)
+        while index != -1 and index < READ_SIZE:
+            if data[index:index + overlap + 1] in BZ2_STREAM_START:
+                yield position + index
+            index = data.find(BZ2_MAGIC, index + 1)
+        position += READ_SIZE
+
+
+def bz2_jobs(raw, size):
+    """Yield (start, end) byte ranges of whole bz2 streams, about JOB_SIZE bytes each"""
+    job_start = None
+    for start in find_bz2_streams(raw, size):
+        if job_start is None:
+            job_start = start
+        elif start - job_start >= JOB_SIZE:
+            yield job_start, start
+            job_start = start
+    if job_start is not None:
+        yield job_start, size
+
+
+def decompress_range(task):
+    """Decompress the whole bz2 streams between two byte offsets of a file, in a worker"""
+    path, start, end = task
+    with open(path, 'rb') as raw:
+        raw.seek(start)
+        return b''.join(data for data, _ in bz2_blocks(raw, end))
+
+
+def parallel_bz2_blocks(raw, path, size, workers):
+    """Yield the decompressed data of a multistream bz2 file in order, with the position
+    in the file, decompressing the streams in a pool of worker processes"""
+    pool = multiprocessing.Pool(workers)
+    pending = deque()
+    try:
+        for start, end in bz2_jobs(raw, size):
+            if end - start > MAX_JOB_SIZE:
+                # Too big to hold in memory at once, so stream it here after the jobs before it.
+                while pending:
+                    job_end, result = pending.popleft()
+                    yield result.get(), job_end
+                stream = open(path, 'rb')
+                try:
+                    stream.seek(start)
+                    for block in bz2_blocks(stream, end):
+                        yield block
+                finally:
+                    stream.close()
+                continue
+            pending.append((end, pool.apply_async(decompress_range, ((path, start, end),))))
+            if len(pending) >= workers * JOBS_AHEAD:
+                job_end, result = pending.popleft()
+                yield result.get(), job_end
+        while pending:
+            job_end, result = pending.popleft()
+            yield result.get(), job_end
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+class DecompressingReader(object):
+    """Read only file-like object over a generator of (decompressed data, position) blocks"""
+
+    def __init__(self, raw, blocks):
+        self.raw = raw
+        self.blocks = blocks
+        self.buffer = b''
+        self.offset = 0
+        self.position = 0
+        self.closed = False
+
+    def read(self, size=-1):
+        parts = []
+        wanted = size if size is not None and size >= 0 else None
+        while wanted is None or wanted > 0:
+            if self.offset >= len(self.buffer):
+                try:
+                    self.buffer, self.position = next(self.blocks)
+                except StopIteration:
+                    break
+                self.offset = 0
+                continue
+            piece = self.buffer[self.offset:self.offset + wanted] if wanted is not None \
+                else self.buffer[self.offset:]
+            self.offset += len(piece)
+            parts.append(piece)
+            if wanted is not None:
+                wanted -= len(piece)
+        return b''.join(parts)
+
+    def tell(self):
+        """How far into the compressed file the data read so far comes from"""
+        return self.position
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.blocks.close()
+            self.raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class RangeReader(object):
+    """Read only file-like object over the top level elements between the byte offsets
+    start and end of an XML file, inside an <osm> element of their own so they parse on
+    their own. tell() gives the position in the file, like DecompressingReader's."""
+
+    def __init__(self, path, start, end):
+        self.raw = open(path, 'rb')
+        self.raw.seek(start)
+        self.end = end
+        self.head = b'<osm>'
+        self.tail = b'</osm>'
+        self.closed = False
+
+    def read(self, size=-1):
+        if self.head:
+            data, self.head = self.head, b''
+            return data
+        remaining = self.end - self.raw.tell()
+        if remaining > 0:
+            return self.raw.read(remaining if size is None or size < 0 else min(size, remaining))
+        data, self.tail = self.tail, b''
+        return data
+
+    def tell(self):
+        return self.raw.tell()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class OSMChild(object):
+    """A <tag> or <nd> child of an OSMElement"""
+    __slots__ = ('tag', 'attrib')
+
+    def __init__(self, tag, attrib):
+        self.tag = tag
+        self.attrib = attrib
+
+    def get(self, key, default=None):
+        return self.attrib.get(key, default)
+
+
+class OSMElement(object):
+    """A node or way read without ElementTree, with the same attributes as the XML.
+
+    attrib holds the element's attributes as strings, tags its (k, v) pairs and refs
+    the node ids of a way's nd children, also as strings."""
+    __slots__ = ('tag', 'attrib', 'tags', 'refs')
+
+    def __init__(self, tag, attrib, tags=(), refs=()):
+        self.tag = tag
+        self.attrib = attrib
+        self.tags = tags
+        self.refs = refs
+
+    def get(self, key, default=None):
+        return self.attrib.get(key, default)
+
+    def iter(self, tag=None):
+        """Yield the <tag> and/or <nd> children, like Element.iter"""
+        if tag in (None, 'nd'):
+            for ref in self.refs:
+                yield OSMChild('nd', {'ref': ref})
+        if tag in (None, 'tag'):
+            for k, v in self.tags:
+                yield OSMChild('tag', {'k': k, 'v': v})
+
+    def __iter__(self):
+        return self.iter()
+
+    def clear(self):
+        pass
+
+
+def expat_elements(source, tags=('node', 'way', 'relation'), keys=None):
+    """Yield an OSMElement for every top level element of the given tags in the XML read
+    from source, using expat directly.
+
+    If keys is given, only the tags with those keys are kept, and only elements that
+    have at least one of them are yielded, which is all the auditors need.
+
+    Only start events are handled. <tag> and <nd> are always empty, so they can be added
+    to the current element as they start, and an element is complete once the next top
+    level element starts, so expat never has to call back into Python for end events."""
+    tags = frozenset(tags)
+    keys = frozenset(keys) if keys is not None else None
+    done = []
+    current = [None]
+
+    def finish():
+        element = current[0]
+        if element is not None and (keys is None or element.tags):
+            done.append(element)
+        current[0] = None
+
+    def start(name, attrs):
+        if name == 'tag':
+            element = current[0]
+            if element is not None:
+                k = attrs['k']
+                if keys is None or k in keys:
+                    element.tags.append((k, attrs['v']))
+        elif name == 'nd':
+            element = current[0]
+            if element is not None:
+                element.refs.append(attrs['ref'])
+        elif name in TOP_LEVEL:
+            finish()
+            if name in tags:
+                current[0] = OSMElement(name, attrs, [], [])
+
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = start
+    while True:
+        data = source.read(PARSE_SIZE)
+        if not data:
+            break
+        parser.Parse(data, False)
+        if done:
+            for element in done:
+                yield element
+            del done[:]
+    parser.Parse(b'', True)
+    finish()
+    for element in done:
+        yield element
+
+
+def open_osm(path, workers=None):
+    """Open an OSM file for reading, decompressing it if it is .gz or .bz2 (see the
+    module docstring). workers is the number of processes used to decompress a
+    multistream bz2 file, DECOMPRESS_WORKERS by default, 1 to decompress it here.
+    For a .pbf file a PBFReader is returned, using workers to decode its blocks."""
+    kind = file_format(path)
+    if kind == 'pbf':
+        # pbf_reader.py builds on this module, so it is imported here.
+        from pbf_reader import PBFReader
+        return PBFReader(path, workers)
+    raw = open(path, 'rb')
+    if kind == 'xml':
+        return raw
+    if kind == 'gzip':
+        return DecompressingReader(raw, gzip_blocks(raw))
+
+    workers = DECOMPRESS_WORKERS if workers is None else workers
+    if workers > 1:
+        raw.seek(0, 2)
+        size = raw.tell()
+        # A single stream file only has a stream start at 0, so only look for a
+        # second one as far as a job could reach.
+        multistream = len(list(islice(find_bz2_streams(raw, size, MAX_JOB_SIZE), 2))) == 2
+        raw.seek(0)
+        if multistream and size > JOB_SIZE:
+            return DecompressingReader(raw, parallel_bz2_blocks(raw, path, size, workers))
+    return DecompressingReader(raw, bz2_blocks(raw))
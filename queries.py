@@ -1,59 +1,92 @@
 import sqlite3
-import csv
 from pprint import pprint
 
+from query_cache import QueryCache
+from summary import has_summary_tables, build_summary_tables
+
 # Put the path to your sqlite database.
 # If no database is available, a new one will be created.
 sqlite_file = 'osm_stchas.sqlite'
 
-# Connecting to the database.
-con = sqlite3.connect(sqlite_file)
-cursor = con.cursor()
+# The results are cached, on disk as well, until the loaders or apply_osc.py change the
+# database, so running the report again doesn't run the aggregations again. See query_cache.py.
+# The database and the cache are only opened when the report is run, not when the
+# queries are imported by the other scripts.
+cache_file = 'osm_stchas_cache.sqlite'
 
-# Number of Nodes
-def number_of_nodes():
-    output = cursor.execute('SELECT COUNT(*) FROM nodes')
-    return output.fetchone()[0]
-print('Number of nodes: %d' % (number_of_nodes()))
+# The reports read the summary tables kept by summary.py, so they only read the rows they return.
+NUMBER_OF_NODES = "SELECT count FROM element_counts WHERE element = 'node'"
 
-# Number of Ways
-def number_of_ways():
-    output = cursor.execute('SELECT COUNT(*) FROM ways')
-    return output.fetchone()[0]
-print('Number of ways: %d' %(number_of_ways()))
+NUMBER_OF_WAYS = "SELECT count FROM element_counts WHERE element = 'way'"
 
-# Number of Unique Users
-def number_of_unique_users():
-    output = cursor.execute('SELECT COUNT(DISTINCT e.uid) FROM \
-                         (SELECT uid FROM nodes UNION ALL SELECT uid FROM ways) e')
-    return output.fetchone()[0]
-print('Number of unique users: %d' %(number_of_unique_users()))
+NUMBER_OF_UNIQUE_USERS = "SELECT count FROM element_counts WHERE element = 'user'"
 
 # Query for Top 10 Amenities in St Charles
-query = "SELECT value, COUNT(*) as num FROM nodes_tags \
+TOP_TEN_AMENITIES = "SELECT value, SUM(count) as num FROM nodes_tag_counts \
             WHERE key='amenity' \
             GROUP BY value \
             ORDER BY num DESC \
             LIMIT 10"
 
-# Top 10 Amenities in St Charles
-def top_ten_amenities_in_st_charles():
-    output = cursor.execute(query)
-    pprint(output.fetchall())
-    return None
-
-print('Top 10 Amenities:\n')
-top_ten_amenities_in_st_charles()
-
 # Type of religions that each place_of_worship value returned
-query = "SELECT value, COUNT(*) as num FROM nodes_tags \
+TYPES_OF_RELIGION = "SELECT value, SUM(count) as num FROM nodes_tag_counts \
             WHERE key='religion' \
             GROUP BY value"
 
-def types_of_religion():
-    output = cursor.execute(query)
-    pprint(output.fetchall())
+# Every report query, by name. indexes.py checks the query plan of each one
+# after the database is loaded, so add new report queries here too.
+REPORT_QUERIES = {
+    'number_of_nodes': NUMBER_OF_NODES,
+    'number_of_ways': NUMBER_OF_WAYS,
+    'number_of_unique_users': NUMBER_OF_UNIQUE_USERS,
+    'top_ten_amenities_in_st_charles': TOP_TEN_AMENITIES,
+    'types_of_religion': TYPES_OF_RELIGION,
+}
+
+# Number of Nodes
+def number_of_nodes(con, cache):
+    output = cache.execute(con, NUMBER_OF_NODES)
+    return output[0][0]
+
+# Number of Ways
+def number_of_ways(con, cache):
+    output = cache.execute(con, NUMBER_OF_WAYS)
+    return output[0][0]
+
+# Number of Unique Users
+def number_of_unique_users(con, cache):
+    output = cache.execute(con, NUMBER_OF_UNIQUE_USERS)
+    return output[0][0]
+
+# Top 10 Amenities in St Charles
+def top_ten_amenities_in_st_charles(con, cache):
+    output = cache.execute(con, TOP_TEN_AMENITIES)
+    pprint(output)
+    return None
+
+def types_of_religion(con, cache):
+    output = cache.execute(con, TYPES_OF_RELIGION)
+    pprint(output)
     return None
 
-print('Different types of shops:\n')
-types_of_religion()
\ No newline at end of file
+
+if __name__ == '__main__':
+    # Connecting to the database.
+    con = sqlite3.connect(sqlite_file)
+    cache = QueryCache(cache_file)
+    # A database loaded before summary.py was added doesn't have the tables the reports read.
+    if not has_summary_tables(con):
+        build_summary_tables(con)
+
+    print('Number of nodes: %d' % (number_of_nodes(con, cache)))
+    print('Number of ways: %d' %(number_of_ways(con, cache)))
+    print('Number of unique users: %d' %(number_of_unique_users(con, cache)))
+
+    print('Top 10 Amenities:\n')
+    top_ten_amenities_in_st_charles(con, cache)
+
+    print('Different types of shops:\n')
+    types_of_religion(con, cache)
+
+    cache.close()
+    con.close()
@@ -0,0 +1,131 @@
+"""A cache of query results that is thrown away when the data in the database changes.
+
+The report queries in queries.py are full aggregations over the tables, but the data only
+changes when creating_db.py or OSM_to_SQL.py rebuild the database, apply_osc.py applies a
+diff or way_geometry.py rebuilds ways_geometry. Each of those stamps the database with a
+new content version, a random number kept in SQLite's user_version header field, with
+bump_version. QueryCache keys each result by the database file, the content version, the
+query text and its parameters, so a result is only reused while the data it came from is
+unchanged.
+
+Results are kept in memory, up to max_entries of them with the least recently used thrown
+out first. Given a path, they are also kept in a small SQLite file of their own, so the
+next run of a report is served from it too. Entries of any other content version of the
+same database are deleted from the file when a new version is first seen.
+
+Anything that changes the tables without calling bump_version, like editing the database
+by hand, isn't noticed. Call bump_version, or clear, after doing that.
+"""
+
+import pickle
+import random
+import sqlite3
+from collections import OrderedDict
+
+# Results kept in memory.
+MAX_ENTRIES = 256
+
+CREATE_CACHE = '''
+    CREATE TABLE IF NOT EXISTS query_cache(database TEXT, version INTEGER, query TEXT,
+    params BLOB, result BLOB, PRIMARY KEY (database, version, query, params))
+'''
+
+
+def content_version(con):
+    """Return the content version stamped on the database, 0 if it was never stamped"""
+    return con.execute('PRAGMA user_version').fetchone()[0]
+
+
+def bump_version(con):
+    """Stamp the database with a new content version, e.g. after loading or changing it.
+    The version is random rather than counted up, so a database that is deleted and
+    built again doesn't start again at a version an old cache entry has."""
+    version = content_version(con)
+    while True:
+        new_version = random.randint(1, 2 ** 31 - 1)
+        if new_version != version:
+            break
+    # PRAGMA can't take parameters, the version is a plain int.
+    con.execute('PRAGMA user_version = %d' % new_version)
+    return new_version
+
+
+def database_path(con):
+    """The file of the connection's main database, '' for an in-memory one"""
+    for _, name, path in con.execute('PRAGMA database_list'):
+        if name == 'main':
+            return path or ''
+    return ''
+
+
+class QueryCache(object):
+    """Runs queries through a cache of their results, see the module docstring"""
+
+    def __init__(self, path=None, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = self.misses = 0
+        self.store = None
+        self.store_versions = {}
+        if path is not None:
+            self.store = sqlite3.connect(path)
+            self.store.execute(CREATE_CACHE)
+            self.store.commit()
+
+    def execute(self, con, query, params=()):
+        """Return the rows of the query as a list, from the cache if the database
+        hasn't changed since it was last run"""
+        database = database_path(con)
+        version = content_version(con)
+        params = tuple(params)
+        key = (database, version, query, params)
+
+        rows = self.entries.pop(key, None)
+        if rows is None and self.store is not None:
+            rows = self.load(database, version, query, params)
+        if rows is None:
+            self.misses += 1
+            rows = tuple(con.execute(query, params).fetchall())
+            if self.store is not None:
+                self.save(database, version, query, params, rows)
+        else:
+            self.hits += 1
+
+        # Put back at the end, as the most recently used.
+        self.entries[key] = rows
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return list(rows)
+
+    def load(self, database, version, query, params):
+        if self.store_versions.get(database) != version:
+            # Only the current version of a database is worth keeping on disk.
+            self.store.execute('DELETE FROM query_cache WHERE database = ? AND version != ?',
+                               (database, version))
+            self.store.commit()
+            self.store_versions[database] = version
+        row = self.store.execute(
+            'SELECT result FROM query_cache WHERE database = ? AND version = ? AND query = ? AND params = ?',
+            (database, version, query, self.dumps(params))).fetchone()
+        return None if row is None else pickle.loads(bytes(row[0]))
+
+    def save(self, database, version, query, params, rows):
+        self.store.execute('INSERT OR REPLACE INTO query_cache VALUES (?, ?, ?, ?, ?)',
+                           (database, version, query, self.dumps(params), self.dumps(rows)))
+        self.store.commit()
+
+    def dumps(self, value):
+        return sqlite3.Binary(pickle.dumps(value, 2))
+
+    def clear(self):
+        """Forget every result, in memory and on disk"""
+        self.entries.clear()
+        self.store_versions.clear()
+        if self.store is not None:
+            self.store.execute('DELETE FROM query_cache')
+            self.store.commit()
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+            self.store = None
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+A small local HTTP service that answers the report queries and tag / bounding box lookups
+as JSON, so other tools don't each have to open the database and run queries.py.
+
+    GET /reports                   the names of the report queries
+    GET /reports/<name>            the rows of one report query from queries.REPORT_QUERIES
+    GET /nodes?bbox=s,w,n,e        the nodes inside a bounding box, with their tags
+    GET /ways?bbox=s,w,n,e         the ways whose bounding box overlaps it, with their tags
+    GET /tags?key=k[&value=v][&bbox=s,w,n,e][&limit=n]
+                                   (id, lat, lon, value) of the nodes with a tag of key
+
+A bounding box is min_lat,min_lon,max_lat,max_lon, as in spatial.py, and the bbox queries
+need its R*Tree index. Tag keys are matched the way they are stored in nodes_tags, so the
+key of addr:street is street.
+
+Every request is handled on a thread of its own. The threads share a ConnectionPool of
+read-only connections: each one has query_only set, so nothing sent to the service can
+change the database, and keeps its own cache of prepared statements, so the fixed query
+texts below are only compiled once per connection. The report results go through a
+QueryCache (see query_cache.py), so they are only run again once the data has changed.
+
+Usage: python query_server.py [osm_stchas.sqlite] [port]
+load_test.py measures the latency of the service under many clients.
+"""
+
+import json
+import sqlite3
+import sys
+import threading
+from contextlib import contextmanager
+
+try:
+    from queue import Queue
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from Queue import Queue
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+from query_cache import QueryCache
+from queries import REPORT_QUERIES
+from spatial import nodes_in_bbox, ways_in_bbox, tagged_nodes_in_bbox
+
+DB_PATH = 'osm_stchas.sqlite'
+HOST = '127.0.0.1'
+PORT = 8642
+
+# Connections in the pool, so at most this many queries run at the same time.
+POOL_SIZE = 8
+
+# Prepared statements each connection keeps.
+CACHED_STATEMENTS = 64
+
+# Rows /tags returns by default, and at most.
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 10000
+
+TAGGED_NODES = '''
+    SELECT n.id, n.lat, n.lon, t.value FROM nodes_tags t JOIN nodes n ON n.id = CAST(t.id AS TEXT)
+    WHERE t.key = :key
+    ORDER BY t.value, n.id LIMIT :limit'''
+
+TAGGED_NODES_WITH_VALUE = '''
+    SELECT n.id, n.lat, n.lon, t.value FROM nodes_tags t JOIN nodes n ON n.id = CAST(t.id AS TEXT)
+    WHERE t.key = :key AND t.value = :value
+    ORDER BY n.id LIMIT :limit'''
+
+
+class BadRequest(Exception):
+    """Raised for a request with missing or malformed parameters"""
+
+
+class ConnectionPool(object):
+    """A fixed number of read-only connections to db, handed out one thread at a time"""
+
+    def __init__(self, db=DB_PATH, size=POOL_SIZE):
+        self.connections = Queue()
+        for _ in range(size):
+            con = sqlite3.connect(db, check_same_thread=False, cached_statements=CACHED_STATEMENTS)
+            con.execute('PRAGMA query_only = ON')
+            self.connections.put(con)
+        self.size = size
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection for the with block, waiting for one if they are all in use"""
+        con = self.connections.get()
+        try:
+            yield con
+        finally:
+            # Reads leave no transaction open, but make sure the next user starts clean.
+            con.rollback()
+            self.connections.put(con)
+
+    def close(self):
+        for _ in range(self.size):
+            self.connections.get().close()
+
+
+def parse_bbox(text):
+    try:
+        bbox = tuple(float(value) for value in text.split(','))
+    except ValueError:
+        bbox = ()
+    if len(bbox) != 4:
+        raise BadRequest('bbox must be min_lat,min_lon,max_lat,max_lon')
+    return bbox
+
+
+def parse_limit(text):
+    try:
+        limit = int(text)
+    except ValueError:
+        raise BadRequest('limit must be a number')
+    return max(0, min(limit, MAX_LIMIT))
+
+
+class QueryService(object):
+    """Answers the requests, see the module docstring"""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.cache = QueryCache()
+        # QueryCache isn't thread safe. Only a report that isn't cached runs while it's held.
+        self.cache_lock = threading.Lock()
+
+    def report(self, name):
+        query = REPORT_QUERIES.get(name)
+        if query is None:
+            return None
+        with self.pool.connection() as con:
+            with self.cache_lock:
+                rows = self.cache.execute(con, query)
+        return {'name': name, 'rows': rows}
+
+    def nodes(self, params):
+        bbox = parse_bbox(self.required(params, 'bbox'))
+        with self.pool.connection() as con:
+            return {'nodes': nodes_in_bbox(con, bbox)}
+
+    def ways(self, params):
+        bbox = parse_bbox(self.required(params, 'bbox'))
+        with self.pool.connection() as con:
+            return {'ways': ways_in_bbox(con, bbox)}
+
+    def tags(self, params):
+        key = self.required(params, 'key')
+        limit = parse_limit(params.get('limit', DEFAULT_LIMIT))
+        value = params.get('value')
+        with self.pool.connection() as con:
+            if 'bbox' in params:
+                rows = tagged_nodes_in_bbox(con, parse_bbox(params['bbox']), key)
+                if value is not None:
+                    rows = [row for row in rows if row[3] == value]
+                rows = rows[:limit]
+            elif value is not None:
+                rows = con.execute(TAGGED_NODES_WITH_VALUE,
+                                   {'key': key, 'value': value, 'limit': limit}).fetchall()
+            else:
+                rows = con.execute(TAGGED_NODES, {'key': key, 'limit': limit}).fetchall()
+        return {'key': key, 'nodes': rows}
+
+    def required(self, params, name):
+        if name not in params:
+            raise BadRequest('missing parameter: %s' % name)
+        return params[name]
+
+    def handle(self, path, params):
+        """Return (status, body) for a GET of path with the given query parameters"""
+        parts = [part for part in path.split('/') if part]
+        if parts == ['reports']:
+            return 200, {'reports': sorted(REPORT_QUERIES)}
+        if len(parts) == 2 and parts[0] == 'reports':
+            body = self.report(parts[1])
+            if body is None:
+                return 404, {'error': 'no report named %s' % parts[1]}
+            return 200, body
+        lookups = {'nodes': self.nodes, 'ways': self.ways, 'tags': self.tags}
+        if len(parts) == 1 and parts[0] in lookups:
+            try:
+                return 200, lookups[parts[0]](params)
+            except BadRequest as e:
+                return 400, {'error': str(e)}
+        return 404, {'error': 'not found: %s' % path}
+
+
+class QueryRequestHandler(BaseHTTPRequestHandler):
+    # Keep connections open between requests, load_test.py clients reuse them.
+    protocol_version = 'HTTP/1.1'
+    # Send the headers and body as one write, with Nagle's algorithm off, so a small
+    # response doesn't wait for the client's delayed ACK.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = dict((name, values[-1]) for name, values in parse_qs(url.query).items())
+        try:
+            status, body = self.server.service.handle(url.path, params)
+        except sqlite3.Error as e:
+            status, body = 500, {'error': 'database error: %s' % e}
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # One line per request on stderr slows the service down under load.
+        pass
+
+
+class QueryServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # The default of 5 waiting connections is too few for a load test.
+    request_queue_size = 128
+
+    def __init__(self, address, service):
+        HTTPServer.__init__(self, address, QueryRequestHandler)
+        self.service = service
+
+
+def serve(db=DB_PATH, host=HOST, port=PORT, pool_size=POOL_SIZE):
+    pool = ConnectionPool(db, pool_size)
+    server = QueryServer((host, port), QueryService(pool))
+    print('Serving %s on http://%s:%d/' % (db, host, server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.close()
+
+
+if __name__ == '__main__':
+    db_path = sys.argv[1] if len(sys.argv) > 1 else DB_PATH
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else PORT
+    serve(db_path, port=port)
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Makes small development extracts of an OSM file that are still valid and complete.
+
+sample1percent.osm was made by keeping every 100th top level line of the file, which
+cuts ways apart and keeps ways whose nodes were dropped. The sampler reads the file with
+OSM_to_CSV.get_element instead, so .gz, .bz2 and .pbf files work too, and picks whole
+elements with one of these modes:
+
+- nth: every nth node and every nth way.
+- reservoir: a uniformly random sample of size elements (nodes and ways together), with
+  reservoir sampling, so the number of elements doesn't need to be known up front.
+- bbox: the nodes inside a bounding box (min_lat,min_lon,max_lat,max_lon), and every way
+  with at least one node inside it.
+- tile: the map is cut into tiles of tile degrees, and one tile in every is picked at
+  random (the same ones for the same seed). The nodes in the picked tiles are kept, and
+  the ways with at least one node in them. Every area that is kept is complete, so the
+  sample has the same mix of streets, buildings and tags per area as the full file.
+
+Every node a kept way refers to is added to the sample, so no way loses its nodes. The
+file is read once. Nodes come before the ways that use them, so every node is written to
+a temporary SQLite database as it streams past, and the nodes needed are read back from
+it in id order at the end. Memory use only depends on the size of the sample. Relations
+are left out, as they are by the rest of the pipeline.
+
+Usage: python sampler.py input.osm output.osm [--mode nth --every 100]
+       python sampler.py input.osm output.osm --mode tile --tile 0.01 --every 10
+"""
+
+from __future__ import print_function
+
+import argparse
+import io
+import random
+import re
+import sqlite3
+import sys
+import zlib
+from xml.sax.saxutils import quoteattr
+
+from OSM_to_CSV import get_element, tag_pairs, node_refs
+
+MODES = ('nth', 'reservoir', 'bbox', 'tile')
+
+DEFAULT_EVERY = 100
+DEFAULT_SIZE = 10000
+DEFAULT_TILE = 0.01
+DEFAULT_SEED = 42
+
+# Nodes written to the temporary database at a time.
+BATCH_SIZE = 10000
+
+# The attributes written first, in this order, like the OSM files from the API.
+NODE_ATTRIBS = ('id', 'lat', 'lon', 'version', 'timestamp', 'changeset', 'uid', 'user')
+WAY_ATTRIBS = ('id', 'version', 'timestamp', 'changeset', 'uid', 'user')
+
+# Characters quoteattr would escape.
+SPECIAL_CHARS = re.compile('[&<>"\n\r\t]')
+
+SPILL_TABLES = [
+    'CREATE TABLE nodes(id INTEGER PRIMARY KEY, xml TEXT, kept INTEGER)',
+    'CREATE TABLE ways(id INTEGER PRIMARY KEY, xml TEXT)',
+    'CREATE TABLE refs(node_id INTEGER)',
+]
+
+
+def quote(value):
+    """quoteattr, without its escaping for the values that don't need any, which is most"""
+    if SPECIAL_CHARS.search(value):
+        return quoteattr(value)
+    return '"%s"' % value
+
+
+def element_xml(element, names):
+    """Return the OSM XML of a node or way, ElementTree element or osm_io.OSMElement"""
+    attrib = element.attrib
+    ordered = [name for name in names if name in attrib]
+    ordered.extend(sorted(name for name in attrib if name not in names))
+    attribs = ' '.join('%s=%s' % (name, quote(attrib[name])) for name in ordered)
+    children = [u'    <nd ref=%s />\n' % quote(ref) for ref in node_refs(element)]
+    children.extend(u'    <tag k=%s v=%s />\n' % (quote(k), quote(v)) for k, v in tag_pairs(element))
+    if not children:
+        return u'  <%s %s />\n' % (element.tag, attribs)
+    return u'  <%s %s>\n%s  </%s>\n' % (element.tag, attribs, u''.join(children), element.tag)
+
+
+def parse_bbox(text):
+    bbox = tuple(float(value) for value in text.split(','))
+    if len(bbox) != 4:
+        raise ValueError('bbox must be min_lat,min_lon,max_lat,max_lon')
+    return bbox
+
+
+class Sampler(object):
+    """Picks the elements of one sample, see the module docstring"""
+
+    def __init__(self, mode='nth', every=DEFAULT_EVERY, size=DEFAULT_SIZE, bbox=None,
+                 tile=DEFAULT_TILE, seed=DEFAULT_SEED):
+        if mode not in MODES:
+            raise ValueError('Unknown sampling mode: %r' % mode)
+        if mode == 'bbox' and bbox is None:
+            raise ValueError('The bbox mode needs a bounding box')
+        self.mode = mode
+        self.every = every
+        self.size = size
+        self.bbox = bbox
+        self.tile = tile
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.counts = {'node': 0, 'way': 0}
+        # The elements in the reservoir, as (tag, id, xml, refs).
+        self.reservoir = []
+
+    def in_tile(self, lat, lon):
+        """Whether the tile the location is in was picked, the same for the same seed"""
+        cell = '%d,%d,%d' % (self.seed, int(lat // self.tile), int(lon // self.tile))
+        return zlib.crc32(cell.encode('ascii')) % self.every == 0
+
+    def keep_node(self, element):
+        if self.mode == 'nth':
+            return self.counts['node'] % self.every == 0
+        lat, lon = float(element.attrib['lat']), float(element.attrib['lon'])
+        if self.mode == 'bbox':
+            min_lat, min_lon, max_lat, max_lon = self.bbox
+            return min_lat <= lat <= max_lat and min_lon <= lon <= max_lon
+        return self.in_tile(lat, lon)
+
+    def add_to_reservoir(self, item):
+        """Algorithm R: the nth element replaces a random one with probability size/n"""
+        seen = self.counts['node'] + self.counts['way']
+        if len(self.reservoir) < self.size:
+            self.reservoir.append(item)
+        else:
+            index = self.rng.randint(0, seen)
+            if index < self.size:
+                self.reservoir[index] = item
+
+
+def sample_osm(file_in, file_out, sampler, backend=None):
+    """Write the sample of file_in picked by sampler to file_out as OSM XML.
+    Returns a dict of the numbers of elements read and written."""
+
+    spill = sqlite3.connect('')
+    for create_sql in SPILL_TABLES:
+        spill.execute(create_sql)
+    nodes = []
+    reservoir = sampler.mode == 'reservoir'
+
+    def flush_nodes():
+        spill.executemany('INSERT OR REPLACE INTO nodes VALUES (?, ?, ?)', nodes)
+        del nodes[:]
+
+    def keep_way(way_id, xml, refs):
+        spill.execute('INSERT OR REPLACE INTO ways VALUES (?, ?)', (way_id, xml))
+        spill.executemany('INSERT INTO refs VALUES (?)', [(int(ref),) for ref in refs])
+
+    try:
+        for element in get_element(file_in, tags=('node', 'way'), backend=backend):
+            element_id = int(element.attrib['id'])
+            if element.tag == 'node':
+                kept = False
+                if reservoir:
+                    sampler.add_to_reservoir(('node', element_id, None, ()))
+                else:
+                    kept = sampler.keep_node(element)
+                nodes.append((element_id, element_xml(element, NODE_ATTRIBS), kept))
+                if len(nodes) >= BATCH_SIZE:
+                    flush_nodes()
+                sampler.counts['node'] += 1
+                continue
+
+            if nodes:
+                flush_nodes()
+            refs = node_refs(element)
+            if reservoir:
+                sampler.add_to_reservoir(('way', element_id, element_xml(element, WAY_ATTRIBS), refs))
+            elif sampler.mode == 'nth':
+                if sampler.counts['way'] % sampler.every == 0:
+                    keep_way(element_id, element_xml(element, WAY_ATTRIBS), refs)
+            else:
+                # Keep the way if any of its nodes were kept.
+                for start in range(0, len(refs), 500):
+                    chunk = [int(ref) for ref in refs[start:start + 500]]
+                    if spill.execute('SELECT 1 FROM nodes WHERE kept AND id IN (%s) LIMIT 1'
+                                     % ','.join('?' * len(chunk)), chunk).fetchone():
+                        keep_way(element_id, element_xml(element, WAY_ATTRIBS), refs)
+                        break
+            sampler.counts['way'] += 1
+        flush_nodes()
+
+        for tag, element_id, xml, refs in sampler.reservoir:
+            if tag == 'node':
+                spill.execute('UPDATE nodes SET kept = 1 WHERE id = ?', (element_id,))
+            else:
+                keep_way(element_id, xml, refs)
+
+        spill.execute('CREATE INDEX refs_node_id ON refs(node_id)')
+        written = {'node': 0, 'way': 0}
+        with io.open(file_out, 'w', encoding='utf-8') as f:
+            f.write(u'<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6" generator="sampler.py">\n')
+            for xml, in spill.execute('SELECT xml FROM nodes WHERE kept OR id IN (SELECT node_id FROM refs) '
+                                      'ORDER BY id'):
+                f.write(xml)
+                written['node'] += 1
+            for xml, in spill.execute('SELECT xml FROM ways ORDER BY id'):
+                f.write(xml)
+                written['way'] += 1
+            f.write(u'</osm>\n')
+
+        missing, = spill.execute('SELECT COUNT(DISTINCT node_id) FROM refs '
+                                 'WHERE node_id NOT IN (SELECT id FROM nodes)').fetchone()
+    finally:
+        spill.close()
+
+    return {'nodes_read': sampler.counts['node'], 'ways_read': sampler.counts['way'],
+            'nodes_written': written['node'], 'ways_written': written['way'],
+            'missing_nodes': missing}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Write a complete sample of an OSM file.')
+    parser.add_argument('input', help='OSM file to sample, can be .gz, .bz2 or .pbf')
+    parser.add_argument('output', help='OSM XML file to write the sample to')
+    parser.add_argument('--mode', choices=MODES, default='nth')
+    parser.add_argument('--every', type=int, default=DEFAULT_EVERY,
+                        help='keep every nth element (nth) or one tile in every (tile)')
+    parser.add_argument('--size', type=int, default=DEFAULT_SIZE, help='elements in the sample (reservoir)')
+    parser.add_argument('--bbox', help='min_lat,min_lon,max_lat,max_lon (bbox)')
+    parser.add_argument('--tile', type=float, default=DEFAULT_TILE, help='tile size in degrees (tile)')
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument('--backend', help='XML parser, etree or expat, see OSM_to_CSV.get_element')
+    args = parser.parse_args(argv)
+
+    try:
+        bbox = parse_bbox(args.bbox) if args.bbox else None
+        sampler = Sampler(args.mode, args.every, args.size, bbox, args.tile, args.seed)
+    except ValueError as e:
+        parser.error(str(e))
+    counts = sample_osm(args.input, args.output, sampler, args.backend)
+    print('Read %(nodes_read)d nodes and %(ways_read)d ways, wrote %(nodes_written)d nodes '
+          'and %(ways_written)d ways' % counts)
+    if counts['missing_nodes']:
+        print('%(missing_nodes)d nodes used by the ways kept are not in the input' % counts)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,254 @@
+"""Compiles the cerberus style schema in schema.py into plain Python closures.
+
+cerberus.Validator walks the nested schema dict for every element it validates,
+which made validation the slowest part of OSM_to_CSV.py. compile_schema walks the
+schema once and returns a CompiledValidator with the same validate/errors/document
+interface, so it can be handed to validate_element in place of cerberus.Validator.
+Only the rules used in schema.py are supported: required, type, coerce and schema.
+Error messages are the same as the ones cerberus 1.3 gives for those rules.
+
+compile_rows builds a RowValidator, which checks the rows of one table in batches rather
+than nested element dicts. A batch is checked a column at a time: a coerce like int or
+float is mapped over the whole column, and the types of the string columns are compared as
+a set. That runs in C, not in a Python call per value. Only a batch that fails is checked
+again a row at a time, to find the bad rows and their messages.
+"""
+
+from operator import itemgetter
+
+try:
+    from collections.abc import Mapping, Sequence
+except ImportError:
+    from collections import Mapping, Sequence
+
+try:
+    string_types = basestring
+    string_classes = frozenset([str, unicode])
+    integer_types = (int, long)
+except NameError:
+    string_types = str
+    string_classes = frozenset([str])
+    integer_types = (int,)
+
+SUPPORTED_RULES = frozenset(['required', 'type', 'coerce', 'schema'])
+
+TYPE_CHECKS = {
+    'string': lambda value: isinstance(value, string_types),
+    'integer': lambda value: isinstance(value, integer_types),
+    'float': lambda value: isinstance(value, (float,) + integer_types),
+    'dict': lambda value: isinstance(value, Mapping),
+    'list': lambda value: isinstance(value, Sequence) and not isinstance(value, string_types),
+}
+
+# Coercions whose result always has the type, so it doesn't have to be checked again.
+COERCED_TYPES = frozenset([(int, 'integer'), (int, 'float'), (float, 'float')])
+
+NULL_VALUE = 'null value not allowed'
+REQUIRED_FIELD = 'required field'
+UNKNOWN_FIELD = 'unknown field'
+BAD_TYPE = 'must be of {0} type'
+COERCION_FAILED = "field '{0}' cannot be coerced: {1}"
+
+
+def compile_rule(field, rule):
+    """Return a function that takes a value and returns (value, messages).
+    value is the coerced value and messages is None when the value is valid."""
+
+    unsupported = set(rule) - SUPPORTED_RULES
+    if unsupported:
+        raise ValueError("Field '{0}' uses unsupported rules: {1}".format(field, sorted(unsupported)))
+
+    coerce = rule.get('coerce')
+    type_name = rule.get('type')
+    check = TYPE_CHECKS[type_name] if type_name else None
+    bad_type = BAD_TYPE.format(type_name)
+
+    if type_name == 'dict' and 'schema' in rule:
+        check_contents = compile_mapping(rule['schema'])
+    elif type_name == 'list' and 'schema' in rule:
+        check_contents = compile_sequence(rule['schema'])
+    else:
+        check_contents = None
+
+    def validate_value(value):
+        coerce_error = None
+        if coerce is not None:
+            try:
+                value = coerce(value)
+            except Exception as e:
+                coerce_error = COERCION_FAILED.format(field, e)
+
+        if value is None:
+            messages = [NULL_VALUE]
+        elif check is not None and not check(value):
+            messages = [bad_type]
+        elif check_contents is not None:
+            value, errors = check_contents(value)
+            messages = [errors] if errors else None
+        else:
+            messages = None
+
+        if coerce_error is not None:
+            messages = (messages or []) + [coerce_error]
+        return value, messages
+
+    return validate_value
+
+
+def compile_mapping(schema):
+    """Return a function that validates a dict against a schema of field rules.
+    It returns (document, errors) where errors maps field names to messages."""
+
+    fields = [(field, rule.get('required', False), compile_rule(field, rule))
+              for field, rule in sorted(schema.items())]
+    known = frozenset(schema)
+
+    def validate_mapping(document):
+        result = {}
+        errors = {}
+        for field, required, validate_value in fields:
+            if field not in document:
+                if required:
+                    errors[field] = [REQUIRED_FIELD]
+                continue
+            value, messages = validate_value(document[field])
+            result[field] = value
+            if messages:
+                errors[field] = messages
+
+        if len(document) > len(result):
+            for field in document:
+                if field not in known:
+                    result[field] = document[field]
+                    errors[field] = [UNKNOWN_FIELD]
+        return result, errors
+
+    return validate_mapping
+
+
+def compile_sequence(item_rule):
+    """Return a function that validates every item of a list against item_rule.
+    It returns (items, errors) where errors maps item positions to messages."""
+
+    validate_item = compile_rule(None, item_rule)
+
+    def validate_sequence(items):
+        result = []
+        errors = {}
+        for index, item in enumerate(items):
+            item, messages = validate_item(item)
+            result.append(item)
+            if messages:
+                errors[index] = messages
+        return result, errors
+
+    return validate_sequence
+
+
+def compile_column(field, rule):
+    """Return a function that takes a column of values and returns True if every value
+    is valid against rule, without working out which ones aren't"""
+
+    # Also raises ValueError for a rule that isn't supported.
+    validate_value = compile_rule(field, rule)
+    if 'schema' in rule:
+        return lambda column: not any(validate_value(value)[1] for value in column)
+    coerce = rule.get('coerce')
+    type_name = rule.get('type')
+    check = TYPE_CHECKS[type_name] if type_name else None
+
+    def check_column(column):
+        if coerce is not None:
+            try:
+                column = list(map(coerce, column))
+            except Exception:
+                return False
+            if (coerce, type_name) in COERCED_TYPES:
+                return True
+        if type_name == 'string':
+            return set(map(type, column)) <= string_classes
+        if None in column:
+            return False
+        return check is None or all(map(check, column))
+
+    return check_column
+
+
+class RowValidator(object):
+    """Validates batches of rows against the field rules of one dict in a schema, such as
+    schema['node']['schema']. A row is a tuple of values in the order of fields, or a dict
+    of them. See the module docstring."""
+
+    def __init__(self, schema, fields):
+        self.fields = tuple(fields)
+        self.validate_document = compile_mapping(schema)
+        self.check_columns = [compile_column(field, schema[field]) for field in self.fields]
+        self.missing = [field for field, rule in schema.items()
+                        if rule.get('required', False) and field not in self.fields]
+        if len(self.fields) > 1:
+            self.get_values = itemgetter(*self.fields)
+        else:
+            self.get_values = lambda row: (row[self.fields[0]],)
+
+    def valid_batch(self, rows):
+        """True if every row is valid, False if any may not be"""
+        if self.missing:
+            return False
+        if set(map(len, rows)) != set([len(self.fields)]):
+            return False
+        if isinstance(rows[0], Mapping):
+            try:
+                rows = list(map(self.get_values, rows))
+            except (KeyError, TypeError):
+                return False
+        return all(check(column) for check, column in zip(self.check_columns, zip(*rows)))
+
+    def validate_row(self, row):
+        """Return the errors of one row, as CompiledValidator would give for it"""
+        if isinstance(row, Mapping):
+            return self.validate_document(row)[1]
+        errors = self.validate_document(dict(zip(self.fields, row)))[1]
+        for index in range(len(self.fields), len(row)):
+            errors[index] = [UNKNOWN_FIELD]
+        return errors
+
+    def validate_many(self, rows):
+        """Validate a batch of rows and return a list of (position, errors) for every row
+        that does not match the schema."""
+        if not rows or self.valid_batch(rows):
+            return []
+        failures = []
+        for position, row in enumerate(rows):
+            errors = self.validate_row(row)
+            if errors:
+                failures.append((position, errors))
+        return failures
+
+
+class CompiledValidator(object):
+    """Validates documents against a schema compiled ahead of time.
+    Has the same validate(), errors and document interface as cerberus.Validator."""
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.validate_document = compile_mapping(schema)
+        self.errors = {}
+        self.document = None
+
+    def validate(self, document, schema=None):
+        """Return True if document matches the schema, otherwise False.
+        The coerced document is kept in self.document and any errors in self.errors."""
+        if schema is not None and schema is not self.schema:
+            self.__init__(schema)
+        self.document, self.errors = self.validate_document(document)
+        return not self.errors
+
+
+def compile_schema(schema):
+    """Compile a schema dict into a CompiledValidator"""
+    return CompiledValidator(schema)
+
+
+def compile_rows(schema, fields):
+    """Compile the field rules of one table's rows into a RowValidator"""
+    return RowValidator(schema, fields)
@@ -0,0 +1,164 @@
+"""R*Tree spatial index of the nodes and ways, and bounding box queries that use it.
+
+The nodes table has lat and lon columns but nothing to search them by, so any question
+about an area scans every node. build_spatial_index fills two SQLite R*Tree tables:
+nodes_rtree with a point per node, and ways_rtree with the bounding box of every way,
+worked out from ways_nodes joined to nodes. The loaders call it after loading, and
+apply_osc.py keeps it up to date with refresh_element.
+
+A bounding box is given as (min_lat, min_lon, max_lat, max_lon). The R*Tree stores its
+coordinates as 32 bit floats rounded outwards, so a point on or very near the edge of the
+bounding box can be stored just outside it. The queries only use the R*Tree to find the
+boxes overlapping the bounding box, and then check the exact lat and lon of the nodes,
+or the exact bounding box of the ways worked out from their nodes, against it.
+"""
+
+import sqlite3
+
+DB_PATH = 'osm_stchas.sqlite'
+
+CREATE_NODES_RTREE = 'CREATE VIRTUAL TABLE nodes_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon)'
+CREATE_WAYS_RTREE = 'CREATE VIRTUAL TABLE ways_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon)'
+
+# nodes.id is a text column, so the other ids are cast to text to be able to use its index.
+INSERT_NODE_POINTS = '''
+    INSERT INTO nodes_rtree
+    SELECT CAST(id AS INTEGER), lat, lat, lon, lon FROM nodes
+    WHERE lat IS NOT NULL AND lon IS NOT NULL %s
+'''
+
+INSERT_WAY_BOXES = '''
+    INSERT INTO ways_rtree
+    SELECT wn.id, MIN(n.lat), MAX(n.lat), MIN(n.lon), MAX(n.lon)
+    FROM ways_nodes wn JOIN nodes n ON n.id = CAST(wn.node_id AS TEXT)
+    %s
+    GROUP BY wn.id
+'''
+
+# The R*Tree condition for boxes overlapping the bounding box. The stored boxes are
+# rounded outwards, so it finds every node and way that may be in it.
+OVERLAPPING = 'r.max_lat >= :min_lat AND r.min_lat <= :max_lat AND r.max_lon >= :min_lon AND r.min_lon <= :max_lon'
+EXACT_POINT = 'n.lat BETWEEN :min_lat AND :max_lat AND n.lon BETWEEN :min_lon AND :max_lon'
+EXACT_BOX = ('MAX(n.lat) >= :min_lat AND MIN(n.lat) <= :max_lat '
+             'AND MAX(n.lon) >= :min_lon AND MIN(n.lon) <= :max_lon')
+
+NODES_IN_BBOX = '''
+    SELECT n.id, n.lat, n.lon FROM nodes_rtree r JOIN nodes n ON n.id = CAST(r.id AS TEXT)
+    WHERE ''' + OVERLAPPING + ' AND ' + EXACT_POINT
+
+NODE_TAGS_IN_BBOX = '''
+    SELECT t.id, t.key, t.value, t.type FROM nodes_rtree r
+    JOIN nodes n ON n.id = CAST(r.id AS TEXT)
+    JOIN nodes_tags t ON t.id = r.id
+    WHERE ''' + OVERLAPPING + ' AND ' + EXACT_POINT
+
+# The exact bounding box of each way the R*Tree finds, from the lat and lon of its nodes.
+WAYS_IN_BBOX = '''
+    SELECT r.id, MIN(n.lat), MIN(n.lon), MAX(n.lat), MAX(n.lon) FROM ways_rtree r
+    JOIN ways_nodes wn ON wn.id = r.id
+    JOIN nodes n ON n.id = CAST(wn.node_id AS TEXT)
+    WHERE ''' + OVERLAPPING + '''
+    GROUP BY r.id HAVING ''' + EXACT_BOX
+
+# The tags of every way the R*Tree finds. collect_tags keeps the ones of the ways in WAYS_IN_BBOX.
+WAY_TAGS_IN_BBOX = '''
+    SELECT t.id, t.key, t.value, t.type FROM ways_rtree r JOIN ways_tags t ON t.id = r.id
+    WHERE ''' + OVERLAPPING
+
+TAGGED_NODES_IN_BBOX = '''
+    SELECT n.id, n.lat, n.lon, t.value FROM nodes_rtree r
+    JOIN nodes n ON n.id = CAST(r.id AS TEXT)
+    JOIN nodes_tags t ON t.id = r.id AND t.key = :key
+    WHERE ''' + OVERLAPPING + ' AND ' + EXACT_POINT + '''
+    ORDER BY t.value, n.id'''
+
+
+def build_spatial_index(con):
+    """Drop and refill the nodes_rtree and ways_rtree tables from the loaded tables"""
+    for table, create_sql in (('nodes_rtree', CREATE_NODES_RTREE), ('ways_rtree', CREATE_WAYS_RTREE)):
+        con.execute('DROP TABLE IF EXISTS %s' % table)
+        con.execute(create_sql)
+    con.execute(INSERT_NODE_POINTS % '')
+    con.execute(INSERT_WAY_BOXES % '')
+    con.commit()
+
+
+def has_spatial_index(con):
+    return con.execute("SELECT 1 FROM sqlite_master WHERE name = 'nodes_rtree'").fetchone() is not None
+
+
+def refresh_way(con, way_id):
+    con.execute('DELETE FROM ways_rtree WHERE id = ?', (way_id,))
+    con.execute(INSERT_WAY_BOXES % 'WHERE wn.id = :id', {'id': way_id})
+
+
+def refresh_element(con, tag, element_id):
+    """Update the spatial index after the node or way with element_id was created,
+    changed or deleted. Moving a node also changes the box of every way that uses it.
+    Runs inside the caller's transaction."""
+    if tag == 'way':
+        refresh_way(con, element_id)
+        return
+
+    con.execute('DELETE FROM nodes_rtree WHERE id = ?', (element_id,))
+    con.execute(INSERT_NODE_POINTS % 'AND id = :id', {'id': str(element_id)})
+    way_ids = [way_id for way_id, in con.execute(
+        'SELECT DISTINCT id FROM ways_nodes WHERE node_id = ?', (element_id,))]
+    for way_id in way_ids:
+        refresh_way(con, way_id)
+
+
+def bbox_params(bbox, **params):
+    min_lat, min_lon, max_lat, max_lon = bbox
+    params.update(min_lat=min_lat, min_lon=min_lon, max_lat=max_lat, max_lon=max_lon)
+    return params
+
+
+def full_key(key, tag_type):
+    """Put a tag key back together the way it was in the OSM file, e.g. addr:street"""
+    return key if tag_type == 'regular' else tag_type + ':' + key
+
+
+def collect_tags(con, query, params, elements):
+    for element_id, key, value, tag_type in con.execute(query, params):
+        element = elements.get(str(element_id))
+        if element is not None:
+            element['tags'][full_key(key, tag_type)] = value
+
+
+def nodes_in_bbox(con, bbox):
+    """Return a list of dicts with the id, lat, lon and tags of every node in the bounding box"""
+    params = bbox_params(bbox)
+    nodes = {}
+    for node_id, lat, lon in con.execute(NODES_IN_BBOX, params):
+        nodes[node_id] = {'id': node_id, 'lat': lat, 'lon': lon, 'tags': {}}
+    collect_tags(con, NODE_TAGS_IN_BBOX, params, nodes)
+    return sorted(nodes.values(), key=lambda node: int(node['id']))
+
+
+def ways_in_bbox(con, bbox):
+    """Return a list of dicts with the id, bounding box and tags of every way whose
+    bounding box overlaps the bounding box"""
+    params = bbox_params(bbox)
+    ways = {}
+    for way_id, min_lat, min_lon, max_lat, max_lon in con.execute(WAYS_IN_BBOX, params):
+        ways[str(way_id)] = {'id': str(way_id), 'bbox': (min_lat, min_lon, max_lat, max_lon), 'tags': {}}
+    collect_tags(con, WAY_TAGS_IN_BBOX, params, ways)
+    return sorted(ways.values(), key=lambda way: int(way['id']))
+
+
+def tagged_nodes_in_bbox(con, bbox, key):
+    """Return (id, lat, lon, value) for every node in the bounding box with a tag of key"""
+    return con.execute(TAGGED_NODES_IN_BBOX, bbox_params(bbox, key=key)).fetchall()
+
+
+def amenities_in_bbox(con, bbox):
+    """Return (id, lat, lon, amenity) for every amenity node in the bounding box"""
+    return tagged_nodes_in_bbox(con, bbox, 'amenity')
+
+
+if __name__ == '__main__':
+    con = sqlite3.connect(DB_PATH)
+    # The area around Saint Charles' Main Street.
+    for amenity in amenities_in_bbox(con, (38.77, -90.50, 38.80, -90.47)):
+        print(amenity)
@@ -0,0 +1,169 @@
+"""Summary tables the report queries in queries.py read instead of aggregating whole tables.
+
+- element_counts: the number of nodes, ways and distinct users (element 'node', 'way'
+  and 'user').
+- user_contributions: the number of nodes and ways of each uid. Only users with at least
+  one element have a row.
+- nodes_tag_counts and ways_tag_counts: the number of tags of each (key, value, type).
+
+The loaders call build_summary_tables once the data is in, which fills the tables with one
+GROUP BY each and then adds triggers to the element and tag tables. From then on every
+insert and delete, like the ones apply_osc.py makes, updates the counts in the same
+transaction, so the reports only read as many rows as they return. Filling the tables
+after loading rather than with the triggers in place keeps the bulk load fast.
+
+Run it on its own to add the tables to a database loaded before they existed.
+"""
+
+import sqlite3
+
+DB_PATH = 'osm_stchas.sqlite'
+
+# The element tables, the element name used in element_counts, the user_contributions
+# column they count into, their tag table and the table its tags are counted in.
+ELEMENTS = [
+    ('nodes', 'node', 'nodes', 'nodes_tags', 'nodes_tag_counts'),
+    ('ways', 'way', 'ways', 'ways_tags', 'ways_tag_counts'),
+]
+
+SUMMARY_TABLES = [
+    ('element_counts', '''
+        CREATE TABLE element_counts(element TEXT PRIMARY KEY, count INTEGER NOT NULL)
+    '''),
+    ('user_contributions', '''
+        CREATE TABLE user_contributions(uid INTEGER PRIMARY KEY, nodes INTEGER NOT NULL,
+        ways INTEGER NOT NULL)
+    '''),
+    ('nodes_tag_counts', '''
+        CREATE TABLE nodes_tag_counts(key TEXT, value TEXT, type TEXT, count INTEGER NOT NULL,
+        PRIMARY KEY (key, value, type))
+    '''),
+    ('ways_tag_counts', '''
+        CREATE TABLE ways_tag_counts(key TEXT, value TEXT, type TEXT, count INTEGER NOT NULL,
+        PRIMARY KEY (key, value, type))
+    '''),
+]
+
+FILL_SUMMARY_TABLES = [
+    '''INSERT INTO element_counts
+       SELECT 'node', COUNT(*) FROM nodes UNION ALL SELECT 'way', COUNT(*) FROM ways''',
+    '''INSERT INTO user_contributions
+       SELECT uid, SUM(nodes), SUM(ways) FROM
+       (SELECT uid, COUNT(*) AS nodes, 0 AS ways FROM nodes GROUP BY uid
+        UNION ALL SELECT uid, 0, COUNT(*) FROM ways GROUP BY uid)
+       GROUP BY uid''',
+    "INSERT INTO element_counts SELECT 'user', COUNT(*) FROM user_contributions",
+    '''INSERT INTO nodes_tag_counts
+       SELECT key, value, type, COUNT(*) FROM nodes_tags GROUP BY key, value, type''',
+    '''INSERT INTO ways_tag_counts
+       SELECT key, value, type, COUNT(*) FROM ways_tags GROUP BY key, value, type''',
+]
+
+# A user's row is added with their first element and removed with their last one.
+USER_TRIGGERS = '''
+    CREATE TRIGGER user_contributions_insert AFTER INSERT ON user_contributions BEGIN
+        UPDATE element_counts SET count = count + 1 WHERE element = 'user';
+    END;
+    CREATE TRIGGER user_contributions_delete AFTER DELETE ON user_contributions BEGIN
+        UPDATE element_counts SET count = count - 1 WHERE element = 'user';
+    END;
+'''
+
+# The triggers of the element and tag tables, as (table, name, event, body). They are
+# filled in with the table, element and column names of ELEMENTS.
+ELEMENT_TRIGGERS = [
+    ('%(table)s', '%(table)s_summary_insert', 'INSERT', '''
+        UPDATE element_counts SET count = count + 1 WHERE element = '%(element)s';
+        INSERT OR IGNORE INTO user_contributions VALUES (NEW.uid, 0, 0);
+        UPDATE user_contributions SET %(column)s = %(column)s + 1 WHERE uid = NEW.uid;
+    '''),
+    ('%(table)s', '%(table)s_summary_delete', 'DELETE', '''
+        UPDATE element_counts SET count = count - 1 WHERE element = '%(element)s';
+        UPDATE user_contributions SET %(column)s = %(column)s - 1 WHERE uid = OLD.uid;
+        DELETE FROM user_contributions WHERE uid = OLD.uid AND nodes = 0 AND ways = 0;
+    '''),
+    ('%(table)s', '%(table)s_summary_update', 'UPDATE OF uid', '''
+        UPDATE user_contributions SET %(column)s = %(column)s - 1 WHERE uid = OLD.uid;
+        DELETE FROM user_contributions WHERE uid = OLD.uid AND nodes = 0 AND ways = 0;
+        INSERT OR IGNORE INTO user_contributions VALUES (NEW.uid, 0, 0);
+        UPDATE user_contributions SET %(column)s = %(column)s + 1 WHERE uid = NEW.uid;
+    '''),
+    ('%(tags)s', '%(tags)s_summary_insert', 'INSERT', '''
+        INSERT OR IGNORE INTO %(counts)s VALUES (NEW.key, NEW.value, NEW.type, 0);
+        UPDATE %(counts)s SET count = count + 1
+        WHERE key = NEW.key AND value = NEW.value AND type = NEW.type;
+    '''),
+    ('%(tags)s', '%(tags)s_summary_delete', 'DELETE', '''
+        UPDATE %(counts)s SET count = count - 1
+        WHERE key = OLD.key AND value = OLD.value AND type = OLD.type;
+        DELETE FROM %(counts)s
+        WHERE key = OLD.key AND value = OLD.value AND type = OLD.type AND count = 0;
+    '''),
+    ('%(tags)s', '%(tags)s_summary_update', 'UPDATE OF key, value, type', '''
+        UPDATE %(counts)s SET count = count - 1
+        WHERE key = OLD.key AND value = OLD.value AND type = OLD.type;
+        DELETE FROM %(counts)s
+        WHERE key = OLD.key AND value = OLD.value AND type = OLD.type AND count = 0;
+        INSERT OR IGNORE INTO %(counts)s VALUES (NEW.key, NEW.value, NEW.type, 0);
+        UPDATE %(counts)s SET count = count + 1
+        WHERE key = NEW.key AND value = NEW.value AND type = NEW.type;
+    '''),
+]
+
+
+def summary_triggers(views=()):
+    """The CREATE TRIGGER statements that keep the summary tables up to date.
+
+    The tables in views are the views of compact_schema.py. Their triggers run INSTEAD OF
+    the insert or delete, next to the compact schema's own triggers that make the change.
+    Rows can't be updated through those views, so they get no update triggers."""
+    script = USER_TRIGGERS
+    for table, element, column, tags, counts in ELEMENTS:
+        names = {'table': table, 'element': element, 'column': column, 'tags': tags,
+                 'counts': counts}
+        for on, name, event, body in ELEMENT_TRIGGERS:
+            on, name, body = on % names, name % names, body % names
+            if on not in views:
+                timing = 'AFTER'
+            elif not event.startswith('UPDATE'):
+                timing = 'INSTEAD OF'
+            else:
+                continue
+            script += '    CREATE TRIGGER %s %s %s ON %s BEGIN%sEND;\n' % (name, timing, event, on, body)
+    return script
+
+
+def drop_summary_tables(con):
+    """Drop the summary tables and their triggers"""
+    triggers = [name for name, in con.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'trigger' "
+        "AND (name LIKE '%_summary_%' OR name LIKE 'user_contributions_%')")]
+    for name in triggers:
+        con.execute('DROP TRIGGER IF EXISTS %s' % name)
+    for table, _ in SUMMARY_TABLES:
+        con.execute('DROP TABLE IF EXISTS %s' % table)
+
+
+def build_summary_tables(con):
+    """Fill the summary tables from the loaded data and add the triggers that keep them
+    up to date"""
+    drop_summary_tables(con)
+    for table, create_sql in SUMMARY_TABLES:
+        con.execute(create_sql)
+    for fill_sql in FILL_SUMMARY_TABLES:
+        con.execute(fill_sql)
+    con.commit()
+    views = set(name for name, in con.execute("SELECT name FROM sqlite_master WHERE type = 'view'"))
+    con.executescript(summary_triggers(views))
+    con.commit()
+
+
+def has_summary_tables(con):
+    return con.execute("SELECT 1 FROM sqlite_master WHERE name = 'element_counts'").fetchone() is not None
+
+
+if __name__ == '__main__':
+    con = sqlite3.connect(DB_PATH)
+    build_summary_tables(con)
+    for element, count in con.execute('SELECT element, count FROM element_counts'):
+        print('%s: %d' % (element, count))
@@ -0,0 +1,193 @@
+"""Precomputes the length, centroid and bounding box of every way into a ways_geometry table.
+
+A way's shape is only stored as its ways_nodes rows pointing at nodes, so questions like
+"how many km of road are there" need a big join and per-row Python math. This build stage
+loads the node coordinates into NumPy arrays sorted by id, then reads ways_nodes in order
+a batch at a time and works out every way in the batch at once: the nodes are found with
+searchsorted, the haversine length of each segment is summed per way with bincount, and
+the bounding boxes come from reduceat. The results go into ways_geometry, so road network
+statistics are a query on one small table.
+
+Nodes that a way refers to but that aren't in the nodes table are skipped. Ways without
+any known nodes get no row. The centroid is the mean of the way's node positions.
+
+Run it after creating_db.py or OSM_to_SQL.py. apply_osc.py updates the rows of the
+ways it changes with update_way_geometry.
+"""
+
+import sqlite3
+
+# apply_osc.py imports this module to check for the table even without NumPy installed.
+# Only building and updating the table needs it.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from query_cache import bump_version
+
+DB_PATH = 'osm_stchas.sqlite'
+
+# How many ways_nodes rows are read and worked out at a time.
+BATCH_SIZE = 500000
+
+EARTH_RADIUS_M = 6371008.8
+
+CREATE_WAYS_GEOMETRY = '''
+    CREATE TABLE IF NOT EXISTS ways_geometry(id INTEGER PRIMARY KEY, length_m REAL,
+    centroid_lat REAL, centroid_lon REAL, min_lat REAL, min_lon REAL, max_lat REAL, max_lon REAL,
+    node_count INTEGER)
+'''
+
+INSERT_WAYS_GEOMETRY = 'INSERT OR REPLACE INTO ways_geometry VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'
+
+
+def load_node_coordinates(con, node_query='SELECT CAST(id AS INTEGER), lat, lon FROM nodes', params=()):
+    """Return (ids, lats, lons) arrays of the nodes, sorted by id"""
+    if np is None:
+        raise ImportError('way_geometry.py needs NumPy to build or update ways_geometry')
+    cursor = con.execute(node_query, params)
+    ids, lats, lons = [], [], []
+    while True:
+        rows = cursor.fetchmany(BATCH_SIZE)
+        if not rows:
+            break
+        node_ids, node_lats, node_lons = zip(*rows)
+        ids.append(np.array(node_ids, dtype=np.int64))
+        lats.append(np.array(node_lats, dtype=np.float64))
+        lons.append(np.array(node_lons, dtype=np.float64))
+
+    if not ids:
+        return np.empty(0, dtype=np.int64), np.empty(0), np.empty(0)
+    ids = np.concatenate(ids)
+    lats = np.concatenate(lats)
+    lons = np.concatenate(lons)
+    order = np.argsort(ids, kind='mergesort')
+    return ids[order], lats[order], lons[order]
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Distance in meters between arrays of points given in degrees"""
+    lat1, lon1, lat2, lon2 = (np.radians(a) for a in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def way_geometry(way_ids, node_ids, node_index):
+    """Work out the geometry of a batch of ways.
+
+    way_ids and node_ids are the ways_nodes rows of whole ways, in (way id, position) order.
+    node_index is the (ids, lats, lons) from load_node_coordinates.
+    Returns a list of ways_geometry rows."""
+    ids, lats, lons = node_index
+    if len(ids) == 0 or len(way_ids) == 0:
+        return []
+
+    positions = np.searchsorted(ids, node_ids)
+    positions[positions == len(ids)] = 0
+    known = ids[positions] == node_ids
+    way_ids = way_ids[known]
+    if len(way_ids) == 0:
+        return []
+    lat = lats[positions[known]]
+    lon = lons[positions[known]]
+
+    starts = np.concatenate(([True], way_ids[1:] != way_ids[:-1]))
+    start_index = np.flatnonzero(starts)
+    group = np.cumsum(starts) - 1
+    way_count = len(start_index)
+
+    # Only segments between two nodes of the same way count towards its length.
+    same_way = ~starts[1:]
+    segments = haversine(lat[:-1], lon[:-1], lat[1:], lon[1:])
+    lengths = np.bincount(group[1:][same_way], weights=segments[same_way], minlength=way_count)
+
+    node_counts = np.bincount(group, minlength=way_count)
+    centroid_lat = np.bincount(group, weights=lat, minlength=way_count) / node_counts
+    centroid_lon = np.bincount(group, weights=lon, minlength=way_count) / node_counts
+
+    return list(zip(way_ids[start_index].tolist(), lengths.tolist(),
+                    centroid_lat.tolist(), centroid_lon.tolist(),
+                    np.minimum.reduceat(lat, start_index).tolist(),
+                    np.minimum.reduceat(lon, start_index).tolist(),
+                    np.maximum.reduceat(lat, start_index).tolist(),
+                    np.maximum.reduceat(lon, start_index).tolist(),
+                    node_counts.tolist()))
+
+
+def way_node_batches(cursor, batch_size=BATCH_SIZE):
+    """Yield (way_ids, node_ids) arrays of about batch_size ways_nodes rows, only ever
+    holding whole ways. The rows must be ordered by way id and position."""
+    carry = []
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        rows = carry + rows
+        # The last way may carry on in the next batch, so hold it back.
+        last_id = rows[-1][0]
+        cut = len(rows)
+        while cut > 0 and rows[cut - 1][0] == last_id:
+            cut -= 1
+        if cut == 0:
+            carry = rows
+            continue
+        carry = rows[cut:]
+        batch = np.array(rows[:cut], dtype=np.int64).reshape(-1, 2)
+        yield batch[:, 0], batch[:, 1]
+    if carry:
+        batch = np.array(carry, dtype=np.int64).reshape(-1, 2)
+        yield batch[:, 0], batch[:, 1]
+
+
+def build_way_geometry(con, batch_size=BATCH_SIZE):
+    """Drop and rebuild the ways_geometry table for every way"""
+    con.execute('DROP TABLE IF EXISTS ways_geometry')
+    con.execute(CREATE_WAYS_GEOMETRY)
+
+    node_index = load_node_coordinates(con)
+    cursor = con.execute('SELECT id, node_id FROM ways_nodes ORDER BY id, position')
+    count = 0
+    for way_ids, node_ids in way_node_batches(cursor, batch_size):
+        rows = way_geometry(way_ids, node_ids, node_index)
+        con.executemany(INSERT_WAYS_GEOMETRY, rows)
+        count += len(rows)
+    bump_version(con)
+    con.commit()
+    return count
+
+
+def has_way_geometry(con):
+    return con.execute("SELECT 1 FROM sqlite_master WHERE name = 'ways_geometry'").fetchone() is not None
+
+
+def update_way_geometry(con, way_ids):
+    """Recompute the ways_geometry rows of the given ways, in the caller's transaction"""
+    way_ids = sorted(set(int(way_id) for way_id in way_ids))
+    if not way_ids:
+        return
+    con.execute('CREATE TEMP TABLE IF NOT EXISTS changed_ways(id INTEGER PRIMARY KEY)')
+    con.execute('DELETE FROM changed_ways')
+    con.executemany('INSERT INTO changed_ways VALUES (?)', [(way_id,) for way_id in way_ids])
+    con.execute('DELETE FROM ways_geometry WHERE id IN (SELECT id FROM changed_ways)')
+
+    node_index = load_node_coordinates(con, '''
+        SELECT CAST(id AS INTEGER), lat, lon FROM nodes WHERE id IN
+        (SELECT CAST(node_id AS TEXT) FROM ways_nodes WHERE id IN (SELECT id FROM changed_ways))
+    ''')
+    cursor = con.execute('''
+        SELECT id, node_id FROM ways_nodes WHERE id IN (SELECT id FROM changed_ways)
+        ORDER BY id, position
+    ''')
+    for batch_way_ids, node_ids in way_node_batches(cursor):
+        con.executemany(INSERT_WAYS_GEOMETRY, way_geometry(batch_way_ids, node_ids, node_index))
+
+
+if __name__ == '__main__':
+    con = sqlite3.connect(DB_PATH)
+    print('ways_geometry rows: %d' % build_way_geometry(con))
+    total, = con.execute("""
+        SELECT SUM(g.length_m) FROM ways_geometry g JOIN ways_tags t ON t.id = g.id
+        WHERE t.key = 'highway'
+    """).fetchone()
+    print('Total length of highways: %.1f km' % ((total or 0) / 1000.0))